@@ -2,10 +2,14 @@
 # For details: reprotest/debian/copyright
 
 import argparse
+import atexit
+import base64
 import collections
+import concurrent.futures
 import configparser
 import contextlib
 import getpass
+import hashlib
 import logging
 import os
 import random
@@ -14,15 +18,19 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import traceback
 import types
+import zlib
 
 import pkg_resources
 
 from reprotest.lib import adtlog
 from reprotest.lib import adt_testbed
-from reprotest.build import Build, VariationSpec, Variations, tool_missing
-from reprotest import environ, presets, shell_syn
+from reprotest.lib import exec_agent
+from reprotest.build import Build, TestbedFacts, VariationSpec, Variations, tool_missing, phases_script, parse_phases, failed_phase
+from reprotest import aptcache, cgroup, daemon, environ, facts, images, presets, shell_syn, source
 
 logger = logging.getLogger(__name__)
 
@@ -52,13 +60,136 @@ def get_all_servers():
 # variety of other options including Docker etc that use different
 # approaches.
 
-class Testbed(adt_testbed.Testbed):
+class TransferStats(collections.namedtuple('_TransferStats',
+    'files bytes seconds mode')):
+    """Size and duration of a copyup or copydown, as measured by the virt server."""
+
+    @property
+    def throughput(self):
+        return self.bytes / self.seconds if self.seconds else float('inf')
+
+    def __str__(self):
+        return "%d files, %.1f MiB in %.2fs (%.1f MiB/s via %s)" % (
+            self.files, self.bytes / 2**20, self.seconds,
+            self.throughput / 2**20, self.mode)
+
 
-    def check_exec2(self, argv, stdout=False, kind='short', xenv=[]):
-        """Like check_exec but does not bomb on stderr, and can pass xenv."""
+# runs exec_agent.py, given compressed and base64-encoded as the first argument
+AGENT_BOOTSTRAP = ("import base64, zlib; ns = {'__name__': 'exec_agent'}; "
+                   "exec(zlib.decompress(base64.b64decode('%s')), ns); ns['main'](['stdio'])")
+
+
+class Testbed(adt_testbed.Testbed):
+    agent = None
+    agent_proc = None
+    has_snapshot = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the virt server runs one command at a time; hold this around
+        # several commands that belong together, e.g. a copy and its stats
+        self.command_lock = threading.RLock()
+
+    def command(self, cmd, args=(), nresults=0, unquote=True):
+        with self.command_lock:
+            return super().command(cmd, args, nresults, unquote)
+
+    def start_agent(self):
+        """Start exec_agent in the testbed, to run the commands of execute()
+        over one connection, instead of running the auxverb for each one."""
+        with open(os.path.splitext(exec_agent.__file__)[0] + '.py', 'rb') as f:
+            src = base64.b64encode(zlib.compress(f.read())).decode()
+        self.agent_proc = subprocess.Popen(
+            self.exec_cmd + ['python3', '-c', AGENT_BOOTSTRAP % src],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.agent = exec_agent.Client(self.agent_proc.stdout.fileno(),
+                                       self.agent_proc.stdin.fileno())
+        if self.agent.run(['true'], timeout=60)[0] != 0:
+            logger.warn("could not start the exec agent in the testbed (is python3 installed?), "
+                        "running commands through the virtual server instead")
+            self.stop_agent()
+
+    def stop_agent(self):
+        if self.agent_proc:
+            self.agent_proc.stdin.close()
+            try:
+                self.agent_proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.agent_proc.kill()
+                self.agent_proc.wait()
+            self.agent_proc.stdout.close()
+        self.agent = self.agent_proc = None
+
+    def execute(self, argv, xenv=[], stdout=None, stderr=None, kind='short', stdin=None):
+        if not self.agent:
+            return super().execute(argv, xenv, stdout, stderr, kind, stdin)
+        argv = self.env_argv(argv, xenv, kind)
+        adtlog.debug('testbed command %s via exec agent, kind %s' % (argv, kind))
+
+        def fd(f, default):
+            # None means capture for exec_agent.Client
+            if f is None:
+                return default
+            if f in (subprocess.PIPE, subprocess.DEVNULL):
+                return None
+            return f if isinstance(f, int) else f.fileno()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        timeout = adt_testbed.timeouts[kind]
+        start = time.time()
+        (code, out, err) = self.agent.run(
+            argv, fd(stdin, None) if stdin != subprocess.DEVNULL else None,
+            fd(stdout, 1), fd(stderr, 2), timeout)
+        if code is None:
+            timed_out = timeout is not None and time.time() - start >= timeout
+            if self.agent.closed:
+                # run the next commands through the virtual server instead
+                logger.warn("giving up on the exec agent in the testbed")
+                self.stop_agent()
+                if not timed_out:
+                    self.bomb('exec agent in the testbed exited')
+            self.bomb('timed out on command "%s" (kind: %s)' % (' '.join(argv), kind))
+        adtlog.debug('testbed command exited with code %i' % code)
+        return (code,
+                out.decode() if stdout == subprocess.PIPE else None,
+                err.decode() if stderr == subprocess.PIPE else None)
+
+    def snapshot(self):
+        """Save the state of the testbed, for revert_snapshot() to return to."""
+        # the agent would not survive being reverted to, so restart it
+        use_agent = self.agent is not None
+        self.stop_agent()
+        self.command('snapshot')
+        self.has_snapshot = True
+        if use_agent:
+            self.start_agent()
+
+    def revert_snapshot(self):
+        use_agent = self.agent is not None
+        self.stop_agent()
+        self._opened(self.command('revert', (), 1))
+        if use_agent:
+            self.start_agent()
+
+    def save_state(self):
+        """Have the virtual server save the testbed, for later runs to start from."""
+        use_agent = self.agent is not None
+        self.stop_agent()
+        name = self.command('save-state', (), 1)[0]
+        if use_agent:
+            self.start_agent()
+        return name
+
+    def transfer_stats(self):
+        """Return the TransferStats of the last copyup or copydown."""
+        files, size, seconds, mode = self.command('transfer-stats', (), 4)
+        return TransferStats(int(files), int(size), float(seconds), mode)
+
+    def check_exec2(self, argv, stdout=False, kind='short', xenv=[], stdin=None):
+        """Like check_exec but does not bomb on stderr, and can pass xenv and stdin."""
         (code, out, err) = self.execute(argv,
                                         stdout=(stdout and subprocess.PIPE or None),
-                                        xenv=xenv, kind=kind)
+                                        xenv=xenv, kind=kind, stdin=stdin)
         if code != 0:
             self.bomb('"%s" failed with status %i' % (' '.join(argv), code),
                       adtlog.AutopkgtestError)
@@ -69,23 +200,155 @@ class Testbed(adt_testbed.Testbed):
         #self.stop() # don't stop when bombing, so we can control it via no_clean_on_error
         raise _type(m)
 
+# set by reprotestd to a daemon.WarmTestbed, for start_testbed() to use
+warm_testbed = None
+
+def usable_apt_cache(testbed, args, apt_cache):
+    '''Return apt_cache if the testbed can use it, otherwise None.'''
+    if apt_cache and 'root-on-testbed' not in testbed.caps:
+        logger.warn("not using the apt cache, it needs root on the testbed")
+        return None
+    elif apt_cache and args[0] == 'null':
+        # the testbed is the host, whose apt has its own cache
+        return None
+    return apt_cache
+
+
 @contextlib.contextmanager
-def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None):
+def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None,
+                  testbed_init=None, use_exec_agent=False, cache_dir=None, snapshot=False,
+                  bake=False, setup=None, setup_key=None, apt_cache=None):
     '''This is a simple wrapper around adt_testbed that automates the
-    initialization and cleanup.'''
+    initialization and cleanup.
+
+    With bake, the testbed is saved as a baked image after testbed_init, see
+    reprotest.images; this needs a cache_dir.
+
+    setup(testbed) is called after testbed_init, before taking a snapshot.
+    If setup_key identifies what it does, it is also saved with the testbed
+    by virtual servers that save it, and skipped when starting from that.
+
+    apt_cache is an aptcache.AptCache for testbed_init and setup to use.'''
+    global warm_testbed
+    if warm_testbed and not warm_testbed.matches(args, testbed_init, host_distro):
+        logger.warn('reprotestd has no warm testbed for these virtual server '
+                    'arguments and --testbed-init, starting a new one')
+    elif warm_testbed and bake:
+        logger.warn('not baking the warm testbed of reprotestd, starting a new one')
+    elif warm_testbed and setup and snapshot and warm_testbed.testbed.has_snapshot:
+        # a snapshot after setup would replace the one that reprotestd
+        # reverts the testbed to after the run
+        logger.warn('cannot take a snapshot of the warm testbed of reprotestd '
+                    'after --testbed-build-pre, starting a new one')
+    elif warm_testbed:
+        logger.info('USING WARM VIRTUAL SERVER %r', args)
+        # reprotestd reverts it after the run, see daemon.WarmTestbed
+        testbed, warm_testbed = warm_testbed.testbed, None
+        # the snapshot of reprotestd is after testbed_init; without setup it
+        # is the one to revert to between builds, if they want one
+        testbed.has_snapshot = testbed.has_snapshot and snapshot
+        if use_exec_agent:
+            testbed.start_agent()
+        try:
+            if setup:
+                apt_cache = usable_apt_cache(testbed, args, apt_cache)
+                if apt_cache:
+                    apt_cache.seed(testbed)
+                setup(testbed)
+                if apt_cache:
+                    apt_cache.harvest(testbed)
+            if snapshot and not testbed.has_snapshot:
+                if 'snapshot' in testbed.caps:
+                    logger.info("taking a snapshot of the testbed to revert to between builds")
+                    testbed.snapshot()
+                else:
+                    logger.warn("virtual server %s cannot take snapshots, builds will "
+                                "clean up after themselves instead", args[0])
+            yield testbed
+        finally:
+            testbed.stop_agent()
+        return
     # Find the location of reprotest using setuptools and then get the
     # path for the correct virt-server script.
     server_path = get_server_path(args[0])
     logger.info('STARTING VIRTUAL SERVER %r', [server_path] + args[1:])
     if no_clean_on_error:
         os.environ["REPROTEST_NO_CLEAN_ON_ERROR"] = "1"
+    # virtual servers that save the testbed after testbed_init, like qemu
+    # with --state-dir, keep one saved state per testbed_init
+    state_init = (testbed_init or '') + ('\0' + setup_key if setup and setup_key else '')
+    # these are for the virtual server only, the builds must not see them
+    server_env = dict(os.environ)
+    server_env["REPROTEST_TESTBED_STATE_TAG"] = hashlib.sha256(state_init.encode()).hexdigest()
+    # whether setup() is part of the saved state that the testbed may start from
+    setup_saved = bool(setup and setup_key)
+    registry = images.ImageRegistry(cache_dir) if cache_dir else None
+    baked = None
+    if registry:
+        image_key = images.image_key(args, state_init, host_distro)
+        if bake:
+            server_env["REPROTEST_BAKE_TO"] = registry.path(image_key)
+        else:
+            baked = registry.get(image_key)
+            if not baked and setup_saved:
+                # one baked without setup() will do as well
+                image_key = images.image_key(args, testbed_init, host_distro)
+                baked = registry.get(image_key)
+                setup_saved = not baked
+        if baked:
+            logger.info("using baked image %s", baked['image'])
+            server_env["REPROTEST_BAKED_IMAGE"] = baked['image']
     # TODO: make the user configurable, like autopkgtest
     testbed = Testbed([server_path] + args[1:], temp_dir,
-                      getpass.getuser(), host_distro=host_distro)
+                      getpass.getuser(), host_distro=host_distro, env=server_env)
+    facts_cache = facts.FactsCache(cache_dir, adt_testbed.VOLATILE_FACTS) if cache_dir else None
+    if facts_cache:
+        # a baked image may differ in more than the volatile facts
+        facts_key = facts.facts_key(args + ([baked['image']] if baked else []), host_distro)
+        testbed.facts = facts_cache.get(facts_key)
+        if testbed.facts is not None:
+            logger.debug("using cached testbed facts %s", facts_key)
     testbed.start()
     testbed.open()
+    if facts_cache:
+        facts_cache.put(facts_key, testbed.facts)
+    if use_exec_agent:
+        testbed.start_agent()
     should_clean = True
+    apt_cache = usable_apt_cache(testbed, args, apt_cache)
     try:
+        runs_apt = (testbed_init or setup) and not (
+            'restored-state' in testbed.caps and (setup_saved or not setup))
+        if apt_cache and runs_apt:
+            apt_cache.seed(testbed)
+        if 'restored-state' in testbed.caps:
+            logger.info("virtual server started from a saved state, which has --testbed-init applied already")
+        else:
+            if baked:
+                logger.warn("baked image %s is gone, run `reprotest bake` again", baked['image'])
+                registry.remove(image_key)
+            if testbed_init:
+                testbed.check_exec2(["sh", "-ec", testbed_init])
+            if setup_saved:
+                setup(testbed)
+            if 'save-state' in testbed.caps:
+                logger.info("saving the testbed, for later runs to start from")
+                image = testbed.save_state()
+                if bake:
+                    registry.put(image_key, image, args, testbed_init)
+                    logger.info("baked image %s", image)
+            elif bake:
+                raise RuntimeError("virtual server %s cannot bake images" % args[0])
+        if setup and not setup_saved:
+            setup(testbed)
+        if apt_cache and runs_apt:
+            apt_cache.harvest(testbed)
+        if snapshot and 'snapshot' in testbed.caps:
+            logger.info("taking a snapshot of the testbed to revert to between builds")
+            testbed.snapshot()
+        elif snapshot:
+            logger.warn("virtual server %s cannot take snapshots, builds will "
+                        "clean up after themselves instead", args[0])
         yield testbed
     except GeneratorExit:
         pass
@@ -95,6 +358,7 @@ def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None):
             should_clean = False
         raise
     finally:
+        testbed.stop_agent()
         if should_clean:
             testbed.stop()
         else:
@@ -105,6 +369,8 @@ def start_testbed(args, temp_dir, no_clean_on_error=False, host_distro=None):
 
 # put build artifacts in ${dist}/source-root, to support tools that put artifacts in ..
 VSRC_DIR = "source-root"
+# timings and other statistics of the run, in the result dir
+RUN_REPORT = "run-report.tsv"
 
 def coroutine(func):
     """A decorator to automatically prime coroutines"""
@@ -130,6 +396,36 @@ def empty_or_temp_dir(empty_dir, name):
             yield temp_dir
 
 
+@contextlib.contextmanager
+def in_background(fn, *args, cleanup=None):
+    """Run fn(*args) in a thread, giving a Future of its result.
+
+    Unlike a ThreadPoolExecutor, leaving the context does not wait for fn:
+    it is cancelled if it has not started yet, and otherwise left to finish
+    on its own, e.g. when the testbed failed to start. cleanup() runs once
+    both the context is left and fn has finished, or at exit.
+    """
+    future = concurrent.futures.Future()
+
+    def run():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield future
+    finally:
+        future.cancel()
+        if cleanup:
+            future.add_done_callback(lambda _: cleanup())
+            if not future.done():
+                # the thread does not keep us from exiting
+                atexit.register(cleanup)
+
+
 def shell_copy_pattern(dst, src, globs):
     # assumes globs is already sanitized
     # mkdir -p dst if it doesn't already exist
@@ -138,12 +434,74 @@ cd "{1}" && cp --parents -a -t "{0}" {2}
 """.format(dst, src, globs)]
 
 
+def prepare_source(source_root, source_pattern, testbed_pre, temp_dir, cache_dir=None,
+                   git_rev=None):
+    """Return (directory, pattern, git revision) of the source tree to copy into
+    the testbed, after applying testbed_pre. If cache_dir is given, the result
+    is looked up and stored there, keyed by a fingerprint of the source.
+
+    Without testbed_pre or cache_dir, source_pattern is left for copydown to
+    apply, and git_rev for copydown to export, which saves a copy of the
+    source on the host.
+    """
+    if not testbed_pre and not (source_pattern and cache_dir):
+        if git_rev and source_pattern:
+            new_source_root = os.path.join(temp_dir, "git")
+            source.git_export(source_root, git_rev, new_source_root)
+            return new_source_root, source_pattern, None
+        return source_root, source_pattern, git_rev
+
+    def prepare(dst):
+        if git_rev and not source_pattern:
+            source.git_export(source_root, git_rev, dst)
+        else:
+            src = source_root
+            if git_rev:
+                src = os.path.join(temp_dir, "git")
+                source.git_export(source_root, git_rev, src)
+            subprocess.check_call(shell_copy_pattern(dst, src, source_pattern or "."))
+        if testbed_pre:
+            subprocess.check_call(["sh", "-ec", testbed_pre], cwd=dst)
+
+    if not cache_dir:
+        new_source_root = os.path.join(temp_dir, "testbed_pre")
+        prepare(new_source_root)
+        return new_source_root, None, None
+
+    cache = source.SourceCache(cache_dir)
+    key = source.fingerprint(source_root, source_pattern, testbed_pre,
+                             git_rev=git_rev, index=source.DirIndex.for_tree(cache_dir, source_root))
+    cached = cache.get(key)
+    if cached:
+        logger.info("using cached source tree: %s", cached)
+        return cached, None, None
+    with cache.add(key) as new_source_root:
+        prepare(new_source_root)
+    logger.info("cached source tree: %s", cache.get(key))
+    return cache.get(key), None, None
+
+
+def source_date_epoch(source_root, git_rev=None, cache_dir=None):
+    """Return the time to fix the builds at: that of the git commit, or
+    else the latest mtime of the files in the source."""
+    if git_rev:
+        return source.git_commit_time(source_root, git_rev)
+    return build.auto_source_date_epoch(source_root, source.DirIndex.for_tree(cache_dir, source_root))
+
+
 class BuildContext(collections.namedtuple('_BuildContext',
-    'testbed_root local_dist_root local_src build_name variations')):
+    'testbed_root local_dist_root local_src local_src_pattern local_src_git_rev build_name variations '
+    'session_root')):
     """
 
     The idiom os.path.join(x, '') is used here to ensure a trailing directory
     separator, which is needed by some things, notably VirtSubProc.
+
+    Builds that run at the same time in one testbed each have a session_root,
+    which is mounted on testbed_root in a mount namespace of their own, so the
+    build sees the same paths as the others (e.g. for the build_path
+    variation) without getting in their way. Outside the build, its files
+    are in session_root.
     """
 
     @property
@@ -151,14 +509,19 @@ class BuildContext(collections.namedtuple('_BuildContext',
         return os.path.join(self.testbed_root, 'build-' + self.build_name, '')
 
     @property
-    def testbed_dist(self):
-        return os.path.join(self.testbed_root, 'artifacts-' + self.build_name, '')
+    def session_src(self):
+        """Where testbed_src is, outside the mount namespace of the build."""
+        return os.path.join(self.session_root or self.testbed_root, 'build-' + self.build_name, '')
 
     @property
     def local_dist(self):
         return os.path.join(self.local_dist_root, self.build_name)
 
-    def make_build_commands(self, script, env):
+    @property
+    def testbed_cgroup_stats(self):
+        return os.path.join(self.session_root or self.testbed_root, 'build-%s.cgroup-stats' % self.build_name)
+
+    def make_build_commands(self, script, env, reverted=False):
         # this dance is necessary because the cwd can't be cd'd into during the
         # setup phase under some variations like user_group
         _ = self.plan_variations(Build.from_command(
@@ -167,7 +530,8 @@ class BuildContext(collections.namedtuple('_BuildContext',
                 'umask "$REPROTEST_UMASK"; unset REPROTEST_UMASK; ' +
                 script,
             env = types.MappingProxyType(env),
-            tree = self.testbed_src
+            tree = self.testbed_src,
+            reverted = reverted,
         ))
         _ = _.append_setup_exec_raw('export', 'REPROTEST_BUILD_PATH=%s' % _.tree)
         _ = _.append_setup_exec_raw('export', 'REPROTEST_UMASK=$(umask)')
@@ -182,22 +546,66 @@ class BuildContext(collections.namedtuple('_BuildContext',
             build = action(self.variations, build, vary)
         return build
 
-    def copydown(self, testbed):
-        logger.info("copying %s over to virtual server's %s", self.local_src, self.testbed_src)
-        testbed.command('copydown', (os.path.join(self.local_src, ''), self.testbed_src))
+    def report(self, what, **values):
+        """Add a line to the run report in the result dir."""
+        with open(os.path.join(self.local_dist_root, RUN_REPORT), 'a') as f:
+            print(self.build_name, what, *("%s=%s" % kv for kv in sorted(values.items())),
+                  sep='\t', file=f)
 
-    def copyup(self, testbed):
-        logger.info("copying %s back from virtual server's %s", self.testbed_dist, self.local_dist)
-        testbed.command('copyup', (self.testbed_dist, os.path.join(self.local_dist, '')))
+    def report_transfer(self, testbed, what):
+        stats = testbed.transfer_stats()
+        logger.info("%s: %s", what, stats)
+        self.report(what, **stats._asdict())
 
-    def run_build(self, testbed, build, old_env, artifact_pattern, testbed_build_pre, no_clean_on_error):
+    def copydown(self, testbed):
+        if self.local_src_git_rev:
+            self.copydown_git(testbed)
+            return
+        logger.info("copying %s over to virtual server's %s", self.local_src, self.session_src)
+        with testbed.command_lock:
+            testbed.command('copydown', (os.path.join(self.local_src, ''), self.session_src)
+                + ((self.local_src_pattern,) if self.local_src_pattern else ()))
+            self.report_transfer(testbed, 'copydown')
+
+    def copydown_git(self, testbed):
+        logger.info("exporting git revision %s of %s to virtual server's %s",
+            self.local_src_git_rev, self.local_src, self.session_src)
+        start = time.time()
+        archive = source.git_archive(self.local_src, self.local_src_git_rev)
+        try:
+            testbed.check_exec2(['sh', '-ec', 'rm -rf "$1"; mkdir -p "$1"; cd "$1"; '
+                'tar --warning=none --no-same-owner -x -f -', 'sh', self.session_src],
+                stdin=archive.stdout, kind='copy')
+        finally:
+            archive.stdout.close()
+            if archive.wait():
+                raise subprocess.CalledProcessError(archive.returncode, archive.args)
+        seconds = time.time() - start
+        logger.info("copydown: git archive in %.2fs", seconds)
+        self.report('copydown', seconds='%.3f' % seconds, mode='git-archive')
+
+    def copyup(self, testbed, artifact_pattern):
+        dist_base = os.path.join(self.local_dist, VSRC_DIR)
+        logger.info("copying %s back from virtual server's %s to %s",
+            artifact_pattern, self.session_src, dist_base)
+        with testbed.command_lock:
+            testbed.command('copyup', (self.session_src, os.path.join(dist_base, ''), artifact_pattern))
+            self.report_transfer(testbed, 'copyup')
+        # FIXME: `touch` is needed because of the FIXME in build.faketime(). we can rm it after that is fixed
+        subprocess.check_call(['sh', '-ec',
+            r"""cd "{0}" && touch -d@0 . .. {1}""".format(dist_base, artifact_pattern)])
+
+    def run_build(self, testbed, build, old_env, artifact_pattern, testbed_build_pre, no_clean_on_error,
+                  fuse_steps=False, cgroup_limits=None, eatmydata=False):
         logger.info("starting build with source directory: %s, artifact pattern: %s",
             self.testbed_src, artifact_pattern)
+        # (name, argv, xenv, kind) of the commands to run in the testbed
+        phases = []
         # we remove existing artifacts in case the build doesn't overwrite it
         # e.g. like how make(1) sometimes works
-        testbed.check_exec2(
+        phases.append(('prepare',
             ['sh', '-ec', 'cd "%s" && rm -rf %s && %s' %
-            (self.testbed_src, artifact_pattern, testbed_build_pre or "true")])
+            (self.session_src, artifact_pattern, testbed_build_pre or "true")], [], 'short'))
         build_script = build.to_script(no_clean_on_error)
         logger.info("executing build in %s", build.tree)
         logger.debug("#### REPROTEST BUILD ENVVARS ###################################################\n" +
@@ -207,23 +615,86 @@ class BuildContext(collections.namedtuple('_BuildContext',
         logger.debug("#### END REPROTEST BUILD SCRIPT ################################################")
 
         if 'root-on-testbed' in testbed.caps:
-            testbed.check_exec2(['chown', testbed.user + ':', self.testbed_root])
+            phases.append(('chown', ['chown', testbed.user + ':', self.session_root or self.testbed_root],
+                           [], 'short'))
             fix_path = 'export PATH=%s; ' % shlex.quote(build.env['PATH']) if 'PATH' in build.env else ''
             build_argv = ['su', '-p', '-s', '/bin/sh', testbed.user,
                 '-c', 'set -e; ' + fix_path + build_script]
             logger.info("su to user '%s' to run the build", testbed.user)
         else:
             build_argv = ['sh', '-ec', build_script]
-
-        testbed.check_exec2(build_argv,
-            xenv=['-i'] + ['%s=%s' % (k, v) for k, v in build.env.items()],
-            kind='build')
+        if eatmydata:
+            build_argv = testbed.eatmydata_prefix + build_argv
+        if cgroup_limits:
+            build_argv = cgroup_limits.wrap(build_argv, self.testbed_cgroup_stats)
+        if self.session_root:
+            build_argv = ['unshare', '--mount', '--propagation', 'private', 'sh', '-ec', SESSION_MOUNT,
+                          'sh', self.session_root, self.testbed_root] + build_argv
+
+        phases.append(('build', build_argv,
+            ['-i'] + ['%s=%s' % (k, v) for k, v in build.env.items()], 'build'))
+
+        if fuse_steps:
+            self.run_phases(testbed, phases)
+        else:
+            for name, argv, xenv, kind in phases:
+                testbed.check_exec2(argv, xenv=xenv, kind=kind)
+        if cgroup_limits:
+            self.report_cgroup(testbed)
         logger.info("build successful, copying artifacts")
-        dist_base = os.path.join(self.testbed_dist, VSRC_DIR)
-        testbed.check_exec2(shell_copy_pattern(dist_base, self.testbed_src, artifact_pattern))
-        # FIXME: `touch` is needed because of the FIXME in build.faketime(). we can rm it after that is fixed
-        testbed.check_exec2(['sh', '-ec',
-            r"""cd "{0}" && touch -d@0 . .. {1}""".format(dist_base, artifact_pattern)])
+
+    def report_cgroup(self, testbed):
+        (code, out, err) = testbed.execute(['cat', self.testbed_cgroup_stats], stdout=subprocess.PIPE,
+                                           stderr=subprocess.DEVNULL)
+        stats = cgroup.parse_stats(out or '')
+        if not stats:
+            logger.warn("no cgroup statistics for the build")
+            return
+        logger.info("build resources: %s", ", ".join("%s=%s" % kv for kv in sorted(stats.items())))
+        self.report('cgroup', **stats)
+
+    def run_phases(self, testbed, phases):
+        """Run the commands of run_build() in one script, to save round-trips."""
+        script = phases_script([(name, testbed.env_argv(argv, xenv, kind))
+                                for name, argv, xenv, kind in phases])
+        (code, out, err) = testbed.execute(['sh', '-c', script],
+                                           stdout=subprocess.PIPE, kind='build')
+        results = parse_phases(out)
+        for name, status, seconds in results:
+            logger.info("%s: exit status %d in %.2fs", name, status, seconds)
+            self.report('phase-' + name, status=status, seconds='%.3f' % seconds)
+        if code != 0:
+            argvs = dict((name, argv) for name, argv, xenv, kind in phases)
+            failed = failed_phase([name for name, argv, xenv, kind in phases], results)
+            argv = argvs[failed] if failed else ['sh', '-c', script]
+            testbed.bomb('"%s" failed with status %i' % (' '.join(argv), code),
+                         adtlog.AutopkgtestError)
+
+
+# $1: session root, $2: where the build sees it, then the build command
+SESSION_MOUNT = 'mkdir -p "$1" "$2"; mount --bind "$1" "$2"; shift 2; exec "$@"'
+
+# $1: mount point, $2: size
+FAST_IO_MOUNT = 'mkdir -p "$1"; mountpoint -q "$1" || mount -t tmpfs -o size="$2",mode=0755 reprotest "$1"'
+
+def fast_io_root(testbed):
+    """Return where to put the builds in testbed for --fast-io.
+
+    That is a tmpfs mounted by mount_fast_io() if the testbed allows it,
+    otherwise testbed.scratch.
+    """
+    if 'root-on-testbed' not in testbed.caps:
+        logger.warn("cannot mount a tmpfs without root on the testbed, "
+                    "only using eatmydata for --fast-io")
+        return testbed.scratch
+    return os.path.join(testbed.scratch, 'fast-io', '')
+
+def mount_fast_io(testbed, path, size):
+    (code, out, err) = testbed.execute(['sh', '-ec', FAST_IO_MOUNT, 'sh', path, size],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if code != 0:
+        testbed.bomb('cannot mount a tmpfs for --fast-io at %s: %s' % (path, err.strip()),
+                     adtlog.AutopkgtestError)
 
 
 def run_or_tee(progargs, filename, store_dir, *args, **kwargs):
@@ -257,17 +728,23 @@ def run_diff(dist_0, dist_1, diffoscope_args, store_dir):
 
 
 class TestbedArgs(collections.namedtuple('_TestbedArgs',
-    'virtual_server_args testbed_pre testbed_init testbed_build_pre host_distro')):
+    'virtual_server_args testbed_pre testbed_init testbed_build_pre host_distro exec_agent snapshot_revert '
+    'build_pre_once apt_cache')):
     @classmethod
-    def of(cls, virtual_server_args=[], testbed_pre=None, testbed_init=None, testbed_build_pre=None, host_distro=None):
-        return cls(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro)
+    def of(cls, virtual_server_args=[], testbed_pre=None, testbed_init=None, testbed_build_pre=None, host_distro=None,
+           exec_agent=False, snapshot_revert=False, build_pre_once=False, apt_cache=None):
+        return cls(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro, exec_agent,
+                   snapshot_revert, build_pre_once, apt_cache)
 
 
 class TestArgs(collections.namedtuple('_Test',
-    'build_command source_root artifact_pattern result_dir source_pattern no_clean_on_error diffoscope_args')):
+    'build_command source_root artifact_pattern result_dir source_pattern no_clean_on_error diffoscope_args cache_dir source_git_rev fuse_build_steps cgroup_limits fast_io '
+    'parallel_builds')):
     @classmethod
     def of(cls, build_command, source_root, artifact_pattern, result_dir=None,
-                source_pattern=None, no_clean_on_error=False, diffoscope_args=['diffoscope']):
+                source_pattern=None, no_clean_on_error=False, diffoscope_args=['diffoscope'],
+                cache_dir=None, source_git_rev=None, fuse_build_steps=False, cgroup_limits=None,
+                fast_io=None, parallel_builds=False):
         artifact_pattern = shell_syn.sanitize_globs(artifact_pattern)
         logger.debug("artifact_pattern sanitized to: %s", artifact_pattern)
 
@@ -275,7 +752,8 @@ class TestArgs(collections.namedtuple('_Test',
             source_pattern = shell_syn.sanitize_globs(source_pattern)
             logger.debug("source_pattern sanitized to: %s", source_pattern)
         return cls(build_command, source_root, artifact_pattern, result_dir,
-                   source_pattern, no_clean_on_error, diffoscope_args)
+                   source_pattern, no_clean_on_error, diffoscope_args, cache_dir, source_git_rev,
+                   fuse_build_steps, cgroup_limits, fast_io, parallel_builds)
 
     @coroutine
     def corun_builds(self, testbed_args):
@@ -285,51 +763,123 @@ class TestArgs(collections.namedtuple('_Test',
         .>>> for name, var in variations:
         .>>>     local_dist = proc.send((name, var))
         .>>>     ...
+
+        Sending a list of (name, var) runs those builds at the same time in
+        the testbed, and returns the list of their local_dist.
         """
-        build_command, source_root, artifact_pattern, result_dir, source_pattern, no_clean_on_error, diffoscope_args = self
-        virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro = testbed_args
+        build_command, source_root, artifact_pattern, result_dir, source_pattern, no_clean_on_error, diffoscope_args, cache_dir, source_git_rev, fuse_build_steps, cgroup_limits, fast_io, parallel_builds = self
+        virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro, use_exec_agent, snapshot_revert, build_pre_once, apt_cache = testbed_args
 
         if not source_root:
             raise ValueError("invalid source root: %s" % source_root)
+        epoch_root = source_root
+        build_pre_key = None
+        if testbed_build_pre and build_pre_once:
+            deps = presets.build_deps(source_root)
+            if deps is not None:
+                build_pre_key = testbed_build_pre + '\0' + deps
         if os.path.isfile(source_root):
             source_root = os.path.normpath(os.path.dirname(source_root))
         source_root = str(source_root)
 
         logger.debug("virtual_server_args: %r", virtual_server_args)
 
+        def prepare(temp_dir, source_root, source_pattern, source_git_rev):
+            base_faketime = '@%d' % source_date_epoch(epoch_root, source_git_rev, cache_dir)
+            prepared = prepare_source(
+                source_root, source_pattern, testbed_pre, temp_dir, cache_dir, source_git_rev)
+            logger.debug("source_root: %s, source_pattern: %s, source_git_rev: %s", *prepared)
+            return prepared, base_faketime
+
+        # prepare the source on the host while the testbed starts, in its own
+        # directory, which may outlive temp_dir if the testbed fails first
+        source_dir = tempfile.mkdtemp()
         # TODO: if no_clean_on_error then this shouldn't be rm'd
-        with tempfile.TemporaryDirectory() as temp_dir:
-            if testbed_pre or source_pattern:
-                new_source_root = os.path.join(temp_dir, "testbed_pre")
-                subprocess.check_call(shell_copy_pattern(new_source_root, source_root, source_pattern or "."))
-                source_root = new_source_root
-            if testbed_pre:
-                subprocess.check_call(["sh", "-ec", testbed_pre], cwd=new_source_root)
-            logger.debug("source_root: %s", source_root)
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                in_background(prepare, source_dir, source_root, source_pattern, source_git_rev,
+                              cleanup=lambda: shutil.rmtree(source_dir, ignore_errors=True)) as prepared:
+
+            def build_pre_setup(testbed):
+                (source_root, source_pattern, source_git_rev), _ = prepared.result()
+                bctx = BuildContext(testbed.scratch, result_dir, source_root, source_pattern,
+                                    source_git_rev, 'build-pre', None, None)
+                bctx.copydown(testbed)
+                logger.info("running --testbed-build-pre once, for all builds")
+                start = time.time()
+                testbed.check_exec2(['sh', '-ec', 'cd "$1"; %s' % testbed_build_pre, 'sh', bctx.testbed_src],
+                                    kind='install')
+                bctx.report('build-pre', seconds='%.3f' % (time.time() - start))
+                testbed.check_exec(['rm', '-rf', bctx.testbed_src])
 
             # TODO: an alternative strategy is to run the testbed many times, one for each build
             # not sure if it's worth implementing at this stage, but perhaps in the future.
             with start_testbed(virtual_server_args, temp_dir, no_clean_on_error,
-                               host_distro=host_distro) as testbed:
-                if testbed_init:
-                    testbed.check_exec2(["sh", "-ec", testbed_init])
-
-                name_variation = yield
-                names_seen = set()
-                while name_variation:
-                    name, var = name_variation
-                    if name in names_seen:
-                        raise ValueError("already built '%s'" % name)
-                    names_seen.add(name)
-
-                    bctx = BuildContext(testbed.scratch, result_dir, source_root, name, var)
-
-                    build = bctx.make_build_commands(build_command, os.environ)
+                               host_distro=host_distro, testbed_init=testbed_init,
+                               use_exec_agent=use_exec_agent, cache_dir=cache_dir,
+                               snapshot=snapshot_revert,
+                               setup=build_pre_setup if testbed_build_pre and build_pre_once else None,
+                               setup_key=build_pre_key, apt_cache=apt_cache) as testbed:
+                (source_root, source_pattern, source_git_rev), base_faketime = prepared.result()
+                testbed_facts = TestbedFacts.of(testbed.facts)
+                testbed_root = testbed.scratch
+                if fast_io:
+                    testbed_root = fast_io_root(testbed)
+                    if not testbed.eatmydata_prefix:
+                        logger.warn("no eatmydata in the testbed, builds will still sync to disk")
+                sessions = 'root-on-testbed' in testbed.caps
+
+                def run_one(name, var, session_root=None):
+                    bctx = BuildContext(os.path.join(testbed_root, 'session', '') if session_root else testbed_root,
+                                        result_dir, source_root, source_pattern, source_git_rev, name,
+                                        var._replace(facts=testbed_facts,
+                                                     base_faketime=var.base_faketime or base_faketime),
+                                        session_root)
+
+                    build = bctx.make_build_commands(build_command, os.environ, testbed.has_snapshot)
+                    if session_root:
+                        testbed.check_exec(['mkdir', '-p', session_root])
                     bctx.copydown(testbed)
-                    bctx.run_build(testbed, build, os.environ, artifact_pattern, testbed_build_pre, no_clean_on_error)
-                    bctx.copyup(testbed)
-
-                    name_variation = yield bctx.local_dist
+                    bctx.run_build(testbed, build, os.environ, artifact_pattern,
+                                   None if build_pre_once else testbed_build_pre, no_clean_on_error,
+                                   fuse_build_steps, cgroup_limits, bool(fast_io))
+                    bctx.copyup(testbed, artifact_pattern)
+                    return bctx.local_dist
+
+                try:
+                    name_variation = yield
+                    names_seen = set()
+                    while name_variation:
+                        batch = name_variation if isinstance(name_variation, list) else [name_variation]
+                        for name, var in batch:
+                            if name in names_seen:
+                                raise ValueError("already built '%s'" % name)
+                            names_seen.add(name)
+
+                        if testbed.has_snapshot and len(names_seen) > len(batch):
+                            logger.info("reverting the testbed to its snapshot")
+                            testbed.revert_snapshot()
+                        if testbed_root != testbed.scratch:
+                            # again, in case reverting the testbed unmounted it
+                            mount_fast_io(testbed, testbed_root, fast_io)
+
+                        if len(batch) > 1 and not sessions:
+                            logger.warn("cannot run builds at the same time without root on the testbed, "
+                                        "running them one after another")
+                            sessions = None
+                        if len(batch) > 1 and sessions:
+                            logger.info("running %d builds at the same time", len(batch))
+                            with concurrent.futures.ThreadPoolExecutor(len(batch)) as pool:
+                                local_dists = list(pool.map(
+                                    lambda nv: run_one(*nv, os.path.join(testbed_root, 'session-' + nv[0], '')),
+                                    batch))
+                        else:
+                            local_dists = [run_one(name, var) for name, var in batch]
+
+                        name_variation = yield (local_dists if isinstance(name_variation, list)
+                                                else local_dists[0])
+                finally:
+                    if testbed_root != testbed.scratch:
+                        testbed.execute(['umount', testbed_root], stderr=subprocess.DEVNULL)
 
     def check_reproducible(self, proc, dist_control, name, var):
         dist_test = proc.send(("experiment-%s" % name, var))
@@ -354,13 +904,16 @@ class TestArgs(collections.namedtuple('_Test',
 
 def check(test_args, testbed_args, build_variations=Variations.of(VariationSpec.default())):
     # default argument [] is safe here because we never mutate it.
-    _, _, artifact_pattern, store_dir, _, _, diffoscope_args = test_args
+    store_dir, diffoscope_args = test_args.result_dir, test_args.diffoscope_args
     with empty_or_temp_dir(store_dir, "store_dir") as result_dir:
         assert store_dir == result_dir or store_dir is None
         proc = test_args._replace(result_dir=result_dir).corun_builds(testbed_args)
 
         bnames = ["control"] + ["experiment-%s" % i for i in range(1, len(build_variations))]
-        local_dists = [proc.send(nv) for nv in zip(bnames, build_variations)]
+        if test_args.parallel_builds:
+            local_dists = proc.send(list(zip(bnames, build_variations)))
+        else:
+            local_dists = [proc.send(nv) for nv in zip(bnames, build_variations)]
 
         retcodes = collections.OrderedDict(
             (bname, run_diff(local_dists[0], dist, diffoscope_args, store_dir))
@@ -385,7 +938,7 @@ def check(test_args, testbed_args, build_variations=Variations.of(VariationSpec.
 
 def check_auto(test_args, testbed_args, build_variations=Variations.of(VariationSpec.default())):
     # default argument [] is safe here because we never mutate it.
-    _, _, _, store_dir, _, _, diffoscope_args = test_args
+    store_dir, diffoscope_args = test_args.result_dir, test_args.diffoscope_args
     with empty_or_temp_dir(store_dir, "store_dir") as result_dir:
         assert store_dir == result_dir or store_dir is None
         proc = test_args._replace(result_dir=result_dir).corun_builds(testbed_args)
@@ -425,7 +978,7 @@ def check_auto(test_args, testbed_args, build_variations=Variations.of(Variation
 
 def check_env(test_args, testbed_args, build_variations=Variations.of(VariationSpec.default())):
     # default argument [] is safe here because we never mutate it.
-    _, _, artifact_pattern, store_dir, _, _, diffoscope_args = test_args
+    store_dir, diffoscope_args = test_args.result_dir, test_args.diffoscope_args
     with empty_or_temp_dir(store_dir, "store_dir") as result_dir:
         assert store_dir == result_dir or store_dir is None
         proc = test_args._replace(result_dir=result_dir).corun_builds(testbed_args)
@@ -466,6 +1019,31 @@ def check_env(test_args, testbed_args, build_variations=Variations.of(VariationS
         return True
 
 
+def bake(testbed_args, cache_dir, no_clean_on_error=False):
+    """Run testbed_init in a new testbed and save it as a baked image.
+
+    Later runs with the same virtual server args, testbed_init and cache_dir
+    start from the baked image instead; see reprotest.images.
+    """
+    virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro, use_exec_agent, snapshot_revert, build_pre_once, apt_cache = testbed_args
+    if not cache_dir:
+        logger.error("reprotest bake needs --cache-dir, to keep the baked images in")
+        return 2
+    if not testbed_init:
+        logger.error("nothing to bake, give --testbed-init or a source with a preset that has one")
+        return 2
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            with start_testbed(virtual_server_args, temp_dir, no_clean_on_error,
+                               host_distro=host_distro, testbed_init=testbed_init,
+                               cache_dir=cache_dir, bake=True, apt_cache=apt_cache):
+                pass
+        except RuntimeError as e:
+            logger.error("%s", e)
+            return 1
+    return 0
+
+
 def config_to_args(parser, filename):
     if not filename:
         return []
@@ -505,7 +1083,15 @@ def cli_parser():
        %(prog)s [options] [-c <build-command>] <source_root> [<artifact_pattern>]
                  [-- <virtual_server_args> [<virtual_server_args> ...]]
        %(prog)s [options] [-s <source_root>] <build_command> [<artifact_pattern>]
-                 [-- <virtual_server_args> [<virtual_server_args> ...]]''',
+                 [-- <virtual_server_args> [<virtual_server_args> ...]]
+       %(prog)s bake --cache-dir=<dir> [options] [<source_root>]
+                 [-- <virtual_server_args> [<virtual_server_args> ...]]
+
+`%(prog)s bake` runs --testbed-init (given, or from the preset of
+<source_root>) in a new testbed and saves the result as an image in
+<dir>. Runs with the same --cache-dir, --testbed-init and virtual server
+args then start from that image. This works with the qemu, lxc and lxd
+virtual servers.''',
         description='Build packages and check them for reproducibility.',
         formatter_class=argparse.RawDescriptionHelpFormatter, add_help=False)
 
@@ -553,6 +1139,13 @@ def cli_parser():
         help='Shell glob pattern to restrict the files in <source_root> that '
         'are made available during the build. Default: empty, i.e. copy the '
         'whole <source_root> directory with no restrictions.')
+    group1.add_argument('--source-from-git', default=None, nargs='?', const='HEAD',
+        metavar='REV',
+        help='Instead of everything in <source_root>, use only the files that '
+        'are tracked by git at the revision REV (Default: HEAD), like '
+        'git-archive(1) does. Untracked, ignored and uncommitted files are '
+        'left out. This also uses the commit time of REV as the base time for '
+        'the time variations, instead of the newest mtime in <source_root>.')
     group1.add_argument('-c', '--build-command', default=None, metavar='COMMANDS',
         help='Build command to execute. If this is "auto" then reprotest will '
         'guess how to build the given source_root, in which case various other '
@@ -560,7 +1153,9 @@ def cli_parser():
     group1.add_argument('--store-dir', default=None, metavar='DIRECTORY',
         help='Save the artifacts in this directory, which must be empty or '
         'non-existent. Otherwise, the artifacts will be deleted and you only '
-        'see their hashes (if reproducible) or the diff output (if not).')
+        'see their hashes (if reproducible) or the diff output (if not). '
+        'Timings of the run, such as the copy throughput, are saved as %s.'
+        % RUN_REPORT)
     group1.add_argument('--variations', default="+all",
         help='Build variations to test as a comma-separated list of variation '
         'names. Default is "+all", equivalent to "%s", testing all available '
@@ -619,6 +1214,23 @@ def cli_parser():
     group3.add_argument('--testbed-build-pre', default=None, metavar='COMMANDS',
         help='Shell commands to run before each build, even before applying '
         'variations for that build. Used to e.g. install build-dependencies.')
+    group3.add_argument('--build-pre-once', action='store_true', default=False,
+        help='Declare that --testbed-build-pre does the same for every build, '
+        'like installing build-dependencies, and run it only once, in a copy '
+        'of the source, before the first build. It then becomes part of what '
+        '--snapshot-revert reverts to, and of states saved by the virtual '
+        'server, like qemu --state-dir, as long as the Build-Depends of a '
+        'Debian source stay the same.')
+    group3.add_argument('--apt-cache', default=None, metavar='DIRECTORY',
+        help='Keep the .debs that apt downloads in testbeds, e.g. for '
+        '--testbed-init or --testbed-build-pre, in this directory on the host, '
+        'and copy them into new testbeds before they run those, so that apt '
+        'does not download them again. Needs root on the testbed; not used '
+        'with the null virtual server.')
+    group3.add_argument('--apt-cache-max-size', default=8 << 30, metavar='SIZE', type=cgroup.parse_size,
+        help='Remove the .debs that were added first to --apt-cache when it '
+        'grows beyond SIZE bytes (with an optional K, M, G or T suffix). '
+        'Default: 8G')
     group3.add_argument('--auto-preset-expr', default="_", metavar='PYTHON_EXPRESSION',
         help='This may be used to transform the presets returned by the '
         'auto-detection feature. The value should be a python expression '
@@ -634,6 +1246,60 @@ def cli_parser():
     group3.add_argument('--print-sudoers', action='store_true', default=False,
         help='Print a sudoers file for passwordless operation using the given '
         '--variations, useful for user_group.available, domain_host.use_sudo.')
+    group3.add_argument('--fuse-build-steps', action='store_true', default=False,
+        help='Run the commands for each build (removing old artifacts, '
+        '--testbed-build-pre, the build itself) as one script in the '
+        'testbed, which saves round-trips on slow virtual servers. The '
+        'duration of each step is saved in the run report. The output of the '
+        'build goes to stderr.')
+    group3.add_argument('--exec-agent', action='store_true', default=False,
+        help='Run a small agent (needs python3) in the testbed, and run the '
+        'commands for the builds through it, instead of starting a new '
+        'auxverb process (e.g. ssh, lxc-attach, schroot) for each one.')
+    group3.add_argument('--cgroup', action='store_true', default=False,
+        help='Run each build in its own cgroup (v2) in the testbed, directly '
+        'if the build runs as root, otherwise in a systemd --user scope. Its '
+        'CPU time, peak memory and I/O are saved in the run report, and '
+        'processes left behind by the build are killed.')
+    group3.add_argument('--cgroup-memory-max', default=None, metavar='SIZE', type=cgroup.parse_size,
+        help='Limit the memory of each build to SIZE bytes (with an optional '
+        'K, M, G or T suffix). Implies --cgroup.')
+    group3.add_argument('--cgroup-cpus', default=None, metavar='NUM', type=float,
+        help='Limit the CPU time of each build to that of NUM CPUs, which '
+        'can be fractional. Implies --cgroup.')
+    group3.add_argument('--parallel-builds', action='store_true', default=False,
+        help='Run the control and experiment builds at the same time in the '
+        'one testbed, each in a mount namespace of its own so that they see '
+        'the same paths. Needs root on the testbed, and unshare(1) and '
+        'mount(8) there; otherwise the builds run one after another. Not '
+        'used with --auto-build or --env-build, whose builds depend on each '
+        'other.')
+    group3.add_argument('--fast-io', default=None, nargs='?', metavar='SIZE', const='50%',
+        help='Build in a tmpfs of at most SIZE (as for mount -o size=, '
+        'default: %(const)s of the testbed\'s memory) if there is root on '
+        'the testbed, and run the builds under eatmydata(1) if it is '
+        'installed there, so that they do not wait for the disk. Note that '
+        'both builds then run on tmpfs, which can hide differences that '
+        'depend on the filesystem, e.g. on the order of directory entries; '
+        'vary fileordering to catch those.')
+    group3.add_argument('--snapshot-revert', action='store_true', default=False,
+        help='Take a snapshot of the testbed after --testbed-init, and revert '
+        'to it between builds, instead of having each build undo its changes '
+        'to the testbed. Needs a virtual server that can take snapshots: lxc '
+        '(with lxc-copy), lxd, or qemu (without --virtiofs).')
+    group3.add_argument('--remote', default=None, nargs='?', metavar='SOCKET',
+        const=daemon.default_socket_path(),
+        help='Run in reprotestd(1) listening on this unix socket (Default: '
+        '%(const)s), which saves starting the virtual server if it has '
+        'one open with the same <virtual_server_args> and --testbed-init.')
+    group3.add_argument('--cache-dir', default=None, metavar='DIRECTORY',
+        help='Keep things that are expensive to prepare in this directory, and '
+        'reuse them in later runs. Currently this is the source tree after '
+        'applying --source-pattern and --testbed-pre, keyed by the names, '
+        'sizes and mtimes of the source files and by the --testbed-pre '
+        'commands; and an index of the directories in <source_root>, to find '
+        'those names and mtimes faster. The directory may be deleted at any '
+        'time. Default: no caching.')
 
     return parser
 
@@ -684,9 +1350,12 @@ def get_main_spec(parsed_args):
     return VariationSpec().extend(variations)
 
 
-def run(argv, dry_run=None):
+def run(argv, dry_run=None, allow_remote=True):
     # Argparse exits with status code 2 if something goes wrong, which
     # is already the right status exit code for reprotest.
+    baking = argv[:1] == ['bake']
+    if baking:
+        argv = argv[1:]
     parser = cli_parser()
     parsed_args = command_line(parser, argv)
     config_args = config_to_args(parser, parsed_args.config_file)
@@ -694,6 +1363,9 @@ def run(argv, dry_run=None):
     parsed_args = command_line(parser, config_args + argv)
     dry_run = parsed_args.dry_run or dry_run
 
+    if parsed_args.remote and allow_remote and not dry_run and not baking:
+        return daemon.run_client(parsed_args.remote, argv)
+
     verbosity = parsed_args.verbosity
     adtlog.verbosity = verbosity - 1
     logging.basicConfig(level=30-10*verbosity)
@@ -715,6 +1387,9 @@ def run(argv, dry_run=None):
     else:
         if parsed_args.source_root:
             build_command = first_arg
+        elif not first_arg and baking:
+            # only bake --testbed-init
+            pass
         elif not first_arg:
             print("No <source_root> or <build_command> provided. See --help for options.")
             sys.exit(2)
@@ -749,13 +1424,18 @@ def run(argv, dry_run=None):
     testbed_build_pre = parsed_args.testbed_build_pre
     diffoscope_args = parsed_args.diffoscope_arg
     source_pattern = parsed_args.source_pattern
+    source_git_rev = parsed_args.source_from_git
+    cache_dir = parsed_args.cache_dir
+    apt_cache = None
+    if parsed_args.apt_cache and not dry_run:
+        apt_cache = aptcache.AptCache(parsed_args.apt_cache, parsed_args.apt_cache_max_size)
     if verbosity >= 3:
         diffoscope_args += ["--debug"]
     elif not verbosity:
         diffoscope_args += ["--no-progress"]
 
     # Do presets
-    if build_command == 'auto':
+    if build_command == 'auto' and (first_arg or not baking):
         auto_preset_expr = parsed_args.auto_preset_expr
         values = presets.get_presets(source_root, virtual_server_args[0])
         values = eval(auto_preset_expr, {'_': values}, {})
@@ -770,6 +1450,11 @@ def run(argv, dry_run=None):
         if values.source_pattern is not None:
             source_pattern = values.source_pattern + (" " + source_pattern if source_pattern else "")
 
+    if baking:
+        testbed_args = TestbedArgs.of(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre,
+                                      parsed_args.host_distro, apt_cache=apt_cache)
+        return bake(testbed_args, cache_dir, parsed_args.no_clean_on_error)
+
     # Variations args
     specs = [get_main_spec(parsed_args)]
     if parsed_args.auto_build:
@@ -783,12 +1468,16 @@ def run(argv, dry_run=None):
     if parsed_args.min_cpus is None and not dry_run:
         logger.warn("The control build runs on 1 CPU by default, give --min-cpus to increase this.")
     min_cpus = parsed_args.min_cpus or 1
+    if parsed_args.fast_io and not any('fileordering' in spec for spec in specs):
+        logger.warn("--fast-io builds on tmpfs, which can hide unreproducibility that depends on "
+                    "the filesystem, like the order of directory entries; vary fileordering to catch it.")
     build_variations = Variations.of(
         *specs,
         verbosity=verbosity,
         min_cpus=min_cpus,
         # TODO: make this configurable via command line
-        base_faketime='@%d' % build.auto_source_date_epoch(source_root))
+        # None: corun_builds() takes it from the source, while the testbed starts
+        base_faketime=None)
 
     # Warn about missing programs
     if virtual_server_args[0] == "null" and not dry_run:
@@ -819,9 +1508,17 @@ def run(argv, dry_run=None):
         print("No <artifact> to test for differences provided. See --help for options.")
         sys.exit(2)
 
-    testbed_args = TestbedArgs.of(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro)
+    cgroup_limits = None
+    if parsed_args.cgroup or parsed_args.cgroup_memory_max or parsed_args.cgroup_cpus:
+        cgroup_limits = cgroup.CgroupLimits.of(parsed_args.cgroup_memory_max, parsed_args.cgroup_cpus)
+
+    testbed_args = TestbedArgs.of(virtual_server_args, testbed_pre, testbed_init, testbed_build_pre, host_distro,
+                                  parsed_args.exec_agent, parsed_args.snapshot_revert,
+                                  parsed_args.build_pre_once, apt_cache)
     test_args = TestArgs.of(build_command, source_root, artifact_pattern, store_dir,
-                            source_pattern, no_clean_on_error, diffoscope_args)
+                            source_pattern, no_clean_on_error, diffoscope_args, cache_dir,
+                            source_git_rev, parsed_args.fuse_build_steps, cgroup_limits,
+                            parsed_args.fast_io, parsed_args.parallel_builds)
 
     check_args = (test_args, testbed_args, build_variations)
     if dry_run:
@@ -0,0 +1,113 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""A cache on the host of the .debs that apt downloads in testbeds.
+
+With --apt-cache, the .debs in the cache are copied into the apt archives
+of each new testbed before --testbed-init, if its virtual server shares a
+directory with the host, so that apt finds them there instead of
+downloading them again; and the .debs that apt downloaded are copied back
+once the testbed is set up. When the cache grows beyond its
+maximum size, the .debs that were added to it first are removed.
+"""
+
+import logging
+import os
+import shlex
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+ARCHIVES = '/var/cache/apt/archives/'
+# apt (unlike apt-get) removes the .debs after installing them by default
+KEEP_CONF = ('mkdir -p "$0"partial; echo \'APT::Keep-Downloaded-Packages "true";\' '
+             '> /etc/apt/apt.conf.d/90reprotest-apt-cache')
+
+
+# the pattern of a copy goes into one argument of a shell in the testbed,
+# which must stay below MAX_ARG_STRLEN (128 KiB)
+PATTERN_MAX = 64 << 10
+
+
+def patterns(names, limit=PATTERN_MAX):
+    """Yield copy patterns that match names, each at most limit bytes long."""
+    batch = []
+    size = 0
+    for name in names:
+        quoted = shlex.quote(name)
+        if batch and size + len(quoted) + 1 > limit:
+            yield ' '.join(batch)
+            batch, size = [], 0
+        batch.append(quoted)
+        size += len(quoted) + 1
+    if batch:
+        yield ' '.join(batch)
+
+
+class AptCache(object):
+    """The .debs in path, at most max_size bytes of them if that is not None."""
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def debs(self):
+        """Return {name: os.stat_result} of the .debs in the cache."""
+        debs = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith('.deb') and entry.is_file():
+                    debs[entry.name] = entry.stat()
+        return debs
+
+    def seed(self, testbed):
+        """Copy the cached .debs into the apt archives of testbed.
+
+        This is only done when the virtual server shares the testbed's
+        downtmp with the host, where it is cheap; copying the whole cache
+        over e.g. qemu's serial line would take longer than downloading.
+        """
+        testbed.check_exec(['sh', '-ec', KEEP_CONF, ARCHIVES])
+        if not testbed.shared_downtmp:
+            logger.info("not copying the apt cache %s to the testbed, it has no directory "
+                        "shared with the host", self.path)
+            return
+        debs = self.debs()
+        if not debs:
+            return
+        logger.info("copying %d .debs from the apt cache %s to the testbed", len(debs), self.path)
+        # the whole directory, as naming every .deb would not fit in one argument
+        staging = os.path.join(testbed.scratch, 'apt-cache', '')
+        testbed.command('copydown', (os.path.join(self.path, ''), staging))
+        testbed.check_exec(['sh', '-ec', 'find "$0" -maxdepth 1 -name "*.deb" -exec mv -f -t "$1" {} +; '
+                            'rm -rf "$0"', staging, ARCHIVES])
+
+    def harvest(self, testbed):
+        """Copy the .debs that are only in the apt archives of testbed to the cache."""
+        out = testbed.check_exec(['sh', '-ec', 'cd "$0"; for f in *.deb; do '
+                                  '[ ! -f "$f" ] || echo "$f"; done', ARCHIVES], stdout=True)
+        cached = self.debs()
+        new = [name for name in out.split() if name not in cached]
+        if new:
+            logger.info("copying %d new .debs from the testbed to the apt cache %s", len(new), self.path)
+            with tempfile.TemporaryDirectory(dir=self.path) as temp_dir:
+                for pattern in patterns(new):
+                    testbed.command('copyup', (ARCHIVES, os.path.join(temp_dir, ''), pattern))
+                for name in new:
+                    os.replace(os.path.join(temp_dir, name), os.path.join(self.path, name))
+                    # evict() goes by when they were added
+                    os.utime(os.path.join(self.path, name))
+        self.evict()
+
+    def evict(self):
+        """Remove the .debs added first until the cache fits in max_size."""
+        if self.max_size is None:
+            return
+        debs = self.debs()
+        size = sum(st.st_size for st in debs.values())
+        for (name, st) in sorted(debs.items(), key=lambda item: item[1].st_mtime):
+            if size <= self.max_size:
+                break
+            os.unlink(os.path.join(self.path, name))
+            size -= st.st_size
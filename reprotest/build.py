@@ -10,12 +10,14 @@ import os
 import shlex
 import shutil
 import random
+import stat
 import time
 import types
 
 from reprotest import environ
 from reprotest import mdiffconf
 from reprotest import shell_syn
+from reprotest import source
 from reprotest.utils import AttributeReplacer
 
 logger = logging.getLogger(__name__)
@@ -47,7 +49,7 @@ def basename(p):
     return os.path.normpath(os.path.basename(os.path.normpath(p)))
 
 
-class Build(collections.namedtuple('_Build', 'build_command setup cleanup env tree aux_tree')):
+class Build(collections.namedtuple('_Build', 'build_command setup cleanup env tree aux_tree reverted')):
     '''Holds the shell ASTs and various other data, used to execute each build.
 
     Fields:
@@ -69,10 +71,13 @@ class Build(collections.namedtuple('_Build', 'build_command setup cleanup env tr
         aux_tree (str): Path where auxilliary files are stored by reprotest.
             When using cls.from_command(), this is automatically created and
             cleaned up by the build script.
+        reverted (bool): Whether the testbed is reverted to a snapshot after
+            the build.  Cleanup commands that only restore the testbed, and
+            are not needed for copying the artifacts back, are left out then.
     '''
 
     @classmethod
-    def from_command(cls, build_command, env, tree):
+    def from_command(cls, build_command, env, tree, reverted=False):
         aux_tree = os.path.join(dirname(tree), basename(tree) + '-aux')
         _ = cls(
             build_command = shell_syn.Command.make(
@@ -82,9 +87,10 @@ class Build(collections.namedtuple('_Build', 'build_command setup cleanup env tr
             env = env,
             tree = tree,
             aux_tree = aux_tree,
+            reverted = reverted,
         )
         _ = _.append_setup_exec('mkdir', '-p', aux_tree)
-        _ = _.prepend_cleanup_exec('rm', '-rf', aux_tree)
+        _ = _.prepend_cleanup_exec('rm', '-rf', aux_tree, restore_only=True)
         return _
 
     def add_env(self, key, value):
@@ -123,18 +129,22 @@ class Build(collections.namedtuple('_Build', 'build_command setup cleanup env tr
     def append_setup_exec_raw(self, *args):
         return self.append_setup(shell_syn.Command.make(*args))
 
-    def prepend_cleanup(self, command):
-        '''Adds a command to the cleanup phase.'''
+    def prepend_cleanup(self, command, restore_only=False):
+        '''Adds a command to the cleanup phase.
+
+        If restore_only, it is left out when the testbed is reverted anyway.'''
+        if restore_only and self.reverted:
+            return self
         # if this command fails, save the exit code but keep executing
         # we run with -e, so it would fail otherwise
         new_cleanup = shell_syn.List.make("{0} || __c=$?".format(command))
         return self._replace(cleanup=new_cleanup + self.cleanup)
 
-    def prepend_cleanup_exec(self, *args):
-        return self.prepend_cleanup_exec_raw(*map(shlex.quote, args))
+    def prepend_cleanup_exec(self, *args, restore_only=False):
+        return self.prepend_cleanup_exec_raw(*map(shlex.quote, args), restore_only=restore_only)
 
-    def prepend_cleanup_exec_raw(self, *args):
-        return self.prepend_cleanup(shell_syn.Command.make(*args))
+    def prepend_cleanup_exec_raw(self, *args, restore_only=False):
+        return self.prepend_cleanup(shell_syn.Command.make(*args), restore_only)
 
     def move_tree(self, source, target, set_tree):
         new_build = self.append_setup_exec(
@@ -191,6 +201,56 @@ cleanup() {{
             return str(subshell)
 
 
+# starts the lines of the trailer of phases_script()
+PHASE_MARKER = 'REPROTEST-PHASE'
+
+def phases_script(phases):
+    '''Generates a shell script that runs several commands, for one round-trip.
+
+    phases is a list of (name, argv), run in turn until one of them fails.
+    Their output goes to stderr; stdout gets a trailer with the exit code
+    and duration of each phase that ran, read by parse_phases().
+    '''
+    lines = ['exec 3>&1 1>&2']
+    for name, argv in phases:
+        lines += [
+            '__t=$(date +%s%N)',
+            '__r=0; {0} || __r=$?'.format(' '.join(shlex.quote(a) for a in argv)),
+            'echo "{0} {1} $__r $(( ($(date +%s%N) - __t) / 1000000 ))" >&3'.format(
+                PHASE_MARKER, shlex.quote(name)),
+            '[ $__r = 0 ] || exit $__r',
+        ]
+    return '\n'.join(lines)
+
+
+def parse_phases(output):
+    '''Returns [(name, exit code, seconds)] of the phases run by phases_script().'''
+    phases = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 4 and parts[0] == PHASE_MARKER:
+            try:
+                phases.append((parts[1], int(parts[2]), int(parts[3]) / 1000))
+            except ValueError:
+                # not ours, e.g. the build printed something like it
+                pass
+    return phases
+
+
+def failed_phase(names, results):
+    '''Returns the name of the phase that failed, given parse_phases() results.
+
+    That is the last one that ran if it failed, otherwise the one after it,
+    which did not get to report (e.g. it was killed); None if all reported
+    success.
+    '''
+    if results and results[-1][1] != 0:
+        return results[-1][0]
+    if len(results) < len(names):
+        return names[len(results)]
+    return None
+
+
 # time zone, locales, disorderfs, host name, user/group, shell, CPU
 # number, architecture for uname (using linux64), umask, HOME, see
 # also: https://tests.reproducible-builds.org/index_variations.html
@@ -222,7 +282,7 @@ def domain_host(ctx, build, vary):
         # create our unshare
         ns_args = ['--uts=%s' % ns_uts]
         _ = _.append_setup_exec(*SUDO, 'unshare', *ns_args, 'true')
-        _ = _.prepend_cleanup_exec(*SUDO, 'umount', ns_uts)
+        _ = _.prepend_cleanup_exec(*SUDO, 'umount', ns_uts, restore_only=True)
         # configure our unshare
         nsenter = SUDO + ['nsenter'] + ns_args
         _ = _.append_setup_exec(*nsenter, 'hostname', hostname)
@@ -243,8 +303,8 @@ def domain_host(ctx, build, vary):
     return _
 
 # Note: this has to go before fileordering because we can't move mountpoints
-# TODO: this variation makes it impossible to parallelise the build, for most
-# of the current virtual servers. (It's theoretically possible to make it work)
+# Builds that run at the same time each see their own const_build_path, see
+# reprotest.BuildContext.session_root.
 def build_path(ctx, build, vary):
     if vary:
         return build
@@ -283,7 +343,17 @@ def home(ctx, build, vary):
 # https://en.wikipedia.org/wiki/Uname
 def kernel(ctx, build, vary):
     _ = build
-    if not vary:
+    facts = ctx.facts
+    if facts:
+        # the same as below, with the values probed when opening the testbed
+        if not vary:
+            _ = _.append_setup_exec_raw('SETARCH_ARCH=%s' % shlex.quote(facts.machine))
+        else:
+            archs = [a for a in facts.setarch_archs if facts.machine not in a]
+            _ = _.append_setup_exec_raw('SETARCH_ARCH=%s' % shlex.quote(random.choice(archs) if archs else ''))
+            if not facts.kernel_release.startswith('2.6'):
+                _ = _.append_setup_exec_raw('SETARCH_OPTS=--uname-2.6')
+    elif not vary:
         _ = _.append_setup_exec_raw('SETARCH_ARCH=$(uname -m)')
     else:
         _ = _.append_setup_exec_raw('SETARCH_ARCH=$(setarch --list | grep -vF "$(uname -m)" | shuf | head -n1)')
@@ -298,10 +368,23 @@ def aslr(ctx, build, vary):
 
 def num_cpus(ctx, build, vary):
     _ = build
-    _ = _.append_setup_exec_raw('CPU_MAX=$(nproc)')
-    _ = _.append_setup_exec_raw('CPU_MIN=$({ echo $CPU_MAX; echo %s; } | sort -n | head -n1)' % ctx.min_cpus)
     if ctx.min_cpus <= 0:
         raise ValueError("--min-cpus must be a positive integer: " % ctx.min_cpus)
+    if ctx.facts:
+        # the same as below, with the number of CPUs probed when opening the testbed
+        cpu_max = ctx.facts.nproc
+        cpu_min = min(cpu_max, ctx.min_cpus)
+        if not vary:
+            cpu_num = cpu_min
+        elif cpu_min == cpu_max:
+            logger.warn("only 1 CPU is available; num_cpus is ineffective")
+            cpu_num = cpu_min
+        else:
+            cpu_num = random.randint(cpu_min + 1, cpu_max)
+        cpu_list = ",".join(map(str, random.sample(range(cpu_max), cpu_num)))
+        return _.prepend_to_build_command_raw('taskset', '-a', '-c', cpu_list)
+    _ = _.append_setup_exec_raw('CPU_MAX=$(nproc)')
+    _ = _.append_setup_exec_raw('CPU_MIN=$({ echo $CPU_MAX; echo %s; } | sort -n | head -n1)' % ctx.min_cpus)
     if not vary:
         _ = _.append_setup_exec_raw('CPU_NUM=$CPU_MIN')
     else:
@@ -449,12 +532,13 @@ def user_group(ctx, build, vary):
         chmod +x "{0}"/fusermount
     '''.format(binpath, " ".join(map(shlex.quote, sudo_command))))
     _ = _.prepend_cleanup_exec('sh', '-ec',
-        'cd "{0}" && rm -f disorderfs mkdir fusermount'.format(binpath))
+        'cd "{0}" && rm -f disorderfs mkdir fusermount'.format(binpath), restore_only=True)
     _ = _.append_setup_exec_raw('export', 'PATH="%s:$PATH"' % binpath)
     if user != olduser:
         _ = _.append_setup_exec(*SUDO, 'chown', '-h', '-R', '--from=%s' % olduser, user, build.tree)
         # TODO: artifacts probably shouldn't be chown'd back
-        _ = _.prepend_cleanup_exec(*SUDO, 'chown', '-h', '-R', '--from=%s' % user, olduser, build.tree)
+        _ = _.prepend_cleanup_exec(*SUDO, 'chown', '-h', '-R', '--from=%s' % user, olduser, build.tree,
+                                   restore_only=True)
     return _
 
 
@@ -482,14 +566,18 @@ VARIATIONS = collections.OrderedDict([
 ])
 
 
-def auto_source_date_epoch(source_root):
+def auto_source_date_epoch(source_root, index=None):
     # Get the latest modification date of all the files in the source root.
     # This tries hard to avoid bad interactions with faketime and make(1) etc.
     # However if you're building this too soon after changing one of the source
     # files then the effect of this variation is not very great.
-    filemtimes = (os.lstat(os.path.join(root, f)).st_mtime
-                  for root, dirs, files in os.walk(source_root)
-                  for f in files)
+    # The index (see source.DirIndex) saves re-reading unchanged directories.
+    if not os.path.isdir(source_root):
+        # e.g. a .dsc or .changes; os.walk() found no files in those, keep that
+        return 1
+    filemtimes = (st.st_mtime
+                  for st in source.scan_tree(source_root, index=index).values()
+                  if st and not stat.S_ISDIR(st.st_mode))
     return int(max(filemtimes, default=1))
 
 
@@ -566,10 +654,25 @@ class VariationSpec(mdiffconf.ImmutableNamespace):
         return [(k, k in self.__dict__, v) for k, v in VARIATIONS.items()]
 
 
-class Variations(collections.namedtuple('_Variations', 'spec verbosity min_cpus base_faketime')):
+class TestbedFacts(collections.namedtuple('_TestbedFacts',
+    'machine kernel_release setarch_archs nproc')):
+    """What the variations need to know about the testbed, so the build
+    scripts don't have to find it out themselves each time."""
+
+    @classmethod
+    def of(cls, facts):
+        """From the facts probed by adt_testbed, or None if some are missing."""
+        try:
+            return cls(facts['machine'].strip(), facts['kernel-release'].strip(),
+                       facts['setarch'].split(), int(facts['nproc']))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+
+class Variations(collections.namedtuple('_Variations', 'spec verbosity min_cpus base_faketime facts')):
     @classmethod
     def of(cls, *specs, zero=VariationSpec.empty(), verbosity=0, min_cpus=1, base_faketime="@0"):
-        return [cls(spec, verbosity, min_cpus, base_faketime) for spec in [zero] + list(specs)]
+        return [cls(spec, verbosity, min_cpus, base_faketime, None) for spec in [zero] + list(specs)]
 
     @property
     def replace(self):
@@ -0,0 +1,118 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Running builds in their own cgroup (v2), for accounting and limits.
+
+The build command is wrapped in a shell script that runs in the testbed.
+It creates a cgroup for the build, directly in /sys/fs/cgroup if it runs as
+root, or else in a delegated systemd scope of the user, applies the limits
+and writes the statistics of the cgroup to a file after the build. Processes
+that the build leaves behind, or all of them when the build is interrupted
+(e.g. by a timeout), are killed with cgroup.kill.
+"""
+
+import collections
+import re
+
+# $0: this script, $1: stats file, $2: memory.max, $3: cpu.max quota
+# (per 100000us), then the build command
+WRAPPER = r'''
+stats=$1; mem=$2; cpu=$3; shift 3
+if [ ! -e /sys/fs/cgroup/cgroup.controllers ]; then
+    echo >&2 "reprotest: no cgroup v2 hierarchy in the testbed, not accounting the build"
+    exec "$@"
+fi
+if [ "$(id -u)" = 0 ]; then
+    parent=/sys/fs/cgroup
+elif [ -z "$REPROTEST_CGROUP_SCOPE" ] && command -v systemd-run >/dev/null; then
+    # e.g. over ssh or in schroot, there may be no user manager to ask
+    if systemd-run --user --scope --quiet true 2>/dev/null; then
+        REPROTEST_CGROUP_SCOPE=1 exec systemd-run --user --scope --quiet -p Delegate=yes -- \
+            sh -c "$0" "$0" "$stats" "$mem" "$cpu" "$@"
+    fi
+    echo >&2 "reprotest: no systemd user session for a cgroup, not accounting the build"
+    exec "$@"
+elif [ -n "$REPROTEST_CGROUP_SCOPE" ]; then
+    # processes can only be in leaves, so move out of the way
+    parent=/sys/fs/cgroup$(sed -n 's/^0:://p' /proc/self/cgroup)
+    { mkdir "$parent/wrapper" && echo $$ > "$parent/wrapper/cgroup.procs"; } 2>/dev/null || parent=
+fi
+for c in memory cpu io; do
+    [ -z "$parent" ] || { echo +$c > "$parent/cgroup.subtree_control"; } 2>/dev/null
+done
+cg=$parent/reprotest-build.$$
+if [ -z "$parent" ] || ! mkdir "$cg" 2>/dev/null; then
+    echo >&2 "reprotest: cannot create a cgroup for the build, not accounting it"
+    exec "$@"
+fi
+[ "$mem" = max ] || { echo "$mem" > "$cg/memory.max"; } 2>/dev/null ||
+    echo >&2 "reprotest: cannot limit the memory of the build"
+[ "$cpu" = max ] || { echo "$cpu 100000" > "$cg/cpu.max"; } 2>/dev/null ||
+    echo >&2 "reprotest: cannot limit the CPU time of the build"
+
+finish() {
+    {
+        sed 's/^/cpu./' "$cg/cpu.stat"
+        echo "memory.peak $(cat "$cg/memory.peak")"
+        awk '{ for (i = 2; i <= NF; i++) { split($i, kv, "="); t[kv[1]] += kv[2] } }
+             END { print "io.rbytes", t["rbytes"] + 0; print "io.wbytes", t["wbytes"] + 0 }' "$cg/io.stat"
+    } > "$stats" 2>/dev/null
+    # whatever the build left running
+    if [ -e "$cg/cgroup.kill" ]; then
+        echo 1 > "$cg/cgroup.kill"
+    else
+        kill -9 $(cat "$cg/cgroup.procs") 2>/dev/null
+    fi
+    while grep -q "populated 1" "$cg/cgroup.events" 2>/dev/null; do sleep 0.1; done
+    rmdir "$cg" 2>/dev/null
+}
+trap 'finish; exit 143' TERM HUP INT
+sh -c 'echo $$ > "$1/cgroup.procs" && shift && exec "$@"' sh "$cg" "$@" 0<&0 &
+wait $!
+rc=$?
+trap - TERM HUP INT
+finish
+exit $rc
+'''
+
+
+def parse_size(size):
+    """Parse a size in bytes, with an optional K, M, G or T suffix."""
+    m = re.match(r'^(\d+)([KMGT]?)$', size.strip().upper())
+    if not m:
+        raise ValueError("invalid size: %s" % size)
+    return int(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2) or ' ')
+
+
+class CgroupLimits(collections.namedtuple('_CgroupLimits', 'memory_max cpus')):
+    """Limits for the cgroup of each build; None means unlimited."""
+
+    @classmethod
+    def of(cls, memory_max=None, cpus=None):
+        return cls(memory_max, cpus)
+
+    def wrap(self, argv, stats_file):
+        """Return argv run in its own cgroup, writing its stats to stats_file."""
+        memory_max = 'max' if self.memory_max is None else str(self.memory_max)
+        cpu_max = 'max' if self.cpus is None else str(int(self.cpus * 100000))
+        return ['sh', '-c', WRAPPER, WRAPPER, stats_file, memory_max, cpu_max] + list(argv)
+
+
+def parse_stats(output):
+    """Return the values of the run report from the stats file of wrap()."""
+    values = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            values[fields[0]] = int(fields[1])
+    names = [
+        ('cpu.usage_usec', 'cpu_seconds'),
+        ('cpu.user_usec', 'cpu_user_seconds'),
+        ('cpu.system_usec', 'cpu_system_seconds'),
+    ]
+    stats = dict((name, '%.3f' % (values[k] / 1e6)) for (k, name) in names if k in values)
+    for (k, name) in [('memory.peak', 'memory_peak'), ('io.rbytes', 'io_read_bytes'),
+                      ('io.wbytes', 'io_write_bytes')]:
+        if k in values:
+            stats[name] = values[k]
+    return stats
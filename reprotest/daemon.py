@@ -0,0 +1,404 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""reprotestd, a daemon that keeps testbeds open for reprotest runs.
+
+Starting a virtual server, opening it and running --testbed-init can take
+much longer than the builds of a small package. reprotestd does this ahead
+of time for a pool of testbeds, and runs the jobs that `reprotest --remote`
+sends to it over a unix socket, each in a forked child that uses one of the
+warm testbeds instead of starting its own. Each warm testbed is kept by a
+process of its own, which reverts it to how it was after --testbed-init
+after each job, or drops it if the virtual server cannot do that.
+
+A job is a single JSON line with the argv, cwd and environment of the
+client, sent together with the client's stdin, stdout and stderr (as
+SCM_RIGHTS). The reply is a JSON line with the return code of the run.
+
+Jobs run as the user of the daemon, so the socket is only accessible to
+that user (mode 0600, in a private directory by default), and connections
+from other users are rejected (SO_PEERCRED).
+"""
+
+import argparse
+import array
+import getpass
+import json
+import logging
+import os
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+import reprotest
+from reprotest.lib import adtlog
+
+logger = logging.getLogger(__name__)
+
+MAX_REQUEST = 1 << 24
+# seconds to wait before starting a testbed again, after one failed to start
+RETRY_DELAY = 10
+
+
+def default_socket_path():
+    if os.getenv('XDG_RUNTIME_DIR'):
+        return os.path.join(os.getenv('XDG_RUNTIME_DIR'), 'reprotestd.sock')
+    # a directory of our own, see private_dir()
+    return os.path.join(tempfile.gettempdir(), 'reprotestd-%d' % os.getuid(), 'reprotestd.sock')
+
+
+def private_dir(path):
+    """Create directory path only accessible to us, or check that it is."""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError("%s is not a directory that only the current user can access" % path)
+
+
+def peer_uid(conn):
+    """Return the uid of the process at the other end of unix socket conn."""
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def run_client(socket_path, argv):
+    """Run reprotest with argv in the daemon listening on socket_path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    return send_job(sock, argv)
+
+
+def send_job(sock, argv):
+    """Send a job to run argv over sock, and return its return code."""
+    request = json.dumps({
+        'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode() + b'\n'
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sock.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                              array.array('i', [0, 1, 2]))])
+    reply = sock.makefile('rb').readline()
+    if not reply:
+        logger.error("reprotestd closed the connection without a result")
+        return 125
+    return json.loads(reply.decode())['returncode']
+
+
+def receive_job(conn):
+    """Return (request, fds) sent by run_client()."""
+    fds = array.array('i')
+    (data, ancdata, flags, addr) = conn.recvmsg(1 << 16, socket.CMSG_LEN(3 * fds.itemsize))
+    for (level, typ, cdata) in ancdata:
+        if level == socket.SOL_SOCKET and typ == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    while not data.endswith(b'\n'):
+        more = conn.recv(1 << 16)
+        if not more or len(data) > MAX_REQUEST:
+            raise ValueError("incomplete request")
+        data += more
+    return json.loads(data.decode()), list(fds)
+
+
+class WarmTestbed(object):
+    """A started and opened testbed, with testbed_init already applied.
+
+    With a virtual server that can take snapshots, one is taken after
+    testbed_init, for clean() to revert to.
+    """
+
+    def __init__(self, virtual_server_args, testbed_init, host_distro, temp_dir):
+        self.virtual_server_args = virtual_server_args
+        self.testbed_init = testbed_init
+        self.host_distro = host_distro
+        server_path = reprotest.get_server_path(virtual_server_args[0])
+        logger.info('STARTING WARM VIRTUAL SERVER %r', [server_path] + virtual_server_args[1:])
+        self.testbed = reprotest.Testbed([server_path] + virtual_server_args[1:], temp_dir,
+                                         getpass.getuser(), host_distro=host_distro)
+        self.testbed.start()
+        self.testbed.open()
+        self.init()
+        if 'snapshot' in self.testbed.caps:
+            self.testbed.snapshot()
+
+    def init(self):
+        if self.testbed_init:
+            self.testbed.check_exec2(["sh", "-ec", self.testbed_init])
+
+    def matches(self, virtual_server_args, testbed_init, host_distro):
+        return (virtual_server_args == self.virtual_server_args and
+                testbed_init == self.testbed_init and
+                host_distro == self.host_distro)
+
+    def clean(self):
+        """Return the testbed to how it was after testbed_init, for the next job.
+
+        Jobs run as root, e.g. install build-dependencies, so removing their
+        files is not enough. Raises RuntimeError if the virtual server can
+        neither revert to the snapshot nor revert the testbed altogether;
+        the testbed must not be used again then.
+        """
+        if self.testbed.has_snapshot:
+            self.testbed.revert_snapshot()
+        elif 'revert' in self.testbed.caps:
+            # back to how the virtual server opened it
+            self.testbed.revert_snapshot()
+            self.init()
+        else:
+            raise RuntimeError("virtual server %s cannot revert the testbed"
+                               % self.virtual_server_args[0])
+
+    def stop(self):
+        try:
+            self.testbed.stop()
+        except Exception as e:
+            logger.warning("stopping testbed failed: %s", e)
+
+
+def run_job(request, fds, warm):
+    """Run a job in a forked child, exiting with its return code."""
+    returncode = 125
+    try:
+        for (i, fd) in enumerate(fds[:3]):
+            os.dup2(fd, i)
+        for fd in fds:
+            os.close(fd)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # let run() set up logging for the verbosity of the job
+        logging.getLogger().handlers = []
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        reprotest.warm_testbed = warm
+        try:
+            returncode = reprotest.run(request['argv'], allow_remote=False)
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1 if e.code else 0
+        if not isinstance(returncode, int):
+            returncode = 0
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        os._exit(returncode)
+
+
+def fork_job(conn, warm=None, close=()):
+    """Receive a job from conn and start it in a child; return its pid, or None.
+
+    The child closes the sockets in close, which are not for the job.
+    """
+    try:
+        (request, fds) = receive_job(conn)
+    except Exception as e:
+        logger.error("bad request: %s", e)
+        return None
+    logger.info("job in %s: %r", request.get('cwd'), request.get('argv'))
+    pid = os.fork()
+    if pid == 0:
+        for sock in [conn] + list(close):
+            sock.close()
+        run_job(request, fds, warm)
+    for fd in fds:
+        os.close(fd)
+    return pid
+
+
+def reply(conn, status):
+    """Send the return code of a job that exited with status to the client."""
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 125
+    try:
+        conn.sendall(json.dumps({'returncode': returncode}).encode() + b'\n')
+    except OSError as e:
+        logger.warning("could not send result: %s", e)
+    conn.close()
+
+
+def hold(sock, virtual_server_args, testbed_init, host_distro, temp_dir):
+    """Keep a warm testbed, and run the jobs that serve() passes on over sock.
+
+    This runs in a child of serve() that has no threads, so that it can fork
+    the jobs safely. It says 'ready' whenever it can take a job, and exits
+    when the testbed cannot be used any more.
+    """
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    warm = None
+    try:
+        warm = WarmTestbed(virtual_server_args, testbed_init, host_distro, temp_dir)
+        while True:
+            sock.sendall(b'ready\n')
+            fds = array.array('i')
+            (data, ancdata, flags, addr) = sock.recvmsg(16, socket.CMSG_LEN(fds.itemsize))
+            if not data:
+                return
+            for (level, typ, cdata) in ancdata:
+                if level == socket.SOL_SOCKET and typ == socket.SCM_RIGHTS:
+                    fds.frombytes(cdata[:fds.itemsize])
+            conn = socket.socket(fileno=fds[0])
+            pid = fork_job(conn, warm, [sock])
+            if pid is None:
+                conn.close()
+                continue
+            (pid, status) = os.waitpid(pid, 0)
+            # the testbed is only known to be in a good state if the job
+            # exited by itself; otherwise it may be in the middle of a
+            # command. clean it before replying, for the next job
+            try:
+                if os.WIFSIGNALED(status):
+                    raise RuntimeError("job killed by signal %d" % os.WTERMSIG(status))
+                warm.clean()
+            except Exception as e:
+                logger.warning("discarding testbed: %s", e)
+                reply(conn, status)
+                return
+            reply(conn, status)
+    except Exception as e:
+        logger.error("could not keep testbed: %s", e)
+    finally:
+        if warm:
+            warm.stop()
+        os._exit(0)
+
+
+def serve(socket_path, pool_size, virtual_server_args, testbed_init, host_distro):
+    if socket_path == default_socket_path():
+        private_dir(os.path.dirname(socket_path))
+    temp_dir = tempfile.mkdtemp(prefix='reprotestd.')
+    # the processes that keep the warm testbeds, see hold(): pid -> socket,
+    # and which of them are ready for a job. this process has no threads,
+    # so that forking them and the jobs is safe
+    holders = {}
+    ready = []
+    warmed = set()
+    # the jobs without a warm testbed: pid -> client connection
+    jobs = {}
+    # when to try again after a testbed failed to start
+    retry_at = [0]
+
+    def refill():
+        """Start holders until there are pool_size of them."""
+        while len(holders) < pool_size and time.time() >= retry_at[0]:
+            (ours, theirs) = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                for sock in [ours, listener] + list(holders.values()):
+                    sock.close()
+                hold(theirs, virtual_server_args, testbed_init, host_distro, temp_dir)
+            theirs.close()
+            holders[pid] = ours
+            sel.register(ours, selectors.EVENT_READ, pid)
+
+    def holder_message(pid):
+        sock = holders[pid]
+        data = sock.recv(16)
+        if data == b'ready\n':
+            ready.append(pid)
+            warmed.add(pid)
+            return
+        # it exited, see hold()
+        sel.unregister(sock)
+        sock.close()
+        del holders[pid]
+        if pid in ready:
+            ready.remove(pid)
+        os.waitpid(pid, 0)
+        if pid not in warmed:
+            retry_at[0] = time.time() + RETRY_DELAY
+        warmed.discard(pid)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    os.chmod(socket_path, 0o600)
+    listener.listen(16)
+    sel = selectors.DefaultSelector()
+    sel.register(listener, selectors.EVENT_READ)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    logger.info("listening on %s", socket_path)
+
+    try:
+        while True:
+            refill()
+            for key, events in sel.select(timeout=1):
+                if key.fileobj is not listener:
+                    holder_message(key.data)
+                    continue
+                (conn, addr) = listener.accept()
+                uid = peer_uid(conn)
+                if uid != os.getuid():
+                    logger.error("rejecting a job from uid %d", uid)
+                    conn.close()
+                    continue
+                if ready:
+                    # the holder receives the job itself, and replies
+                    pid = ready.pop(0)
+                    holders[pid].sendmsg([b'job'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                                     array.array('i', [conn.fileno()]))])
+                    conn.close()
+                    continue
+                pid = fork_job(conn, None, [listener] + list(holders.values()))
+                if pid is None:
+                    conn.close()
+                else:
+                    jobs[pid] = conn
+
+            for pid in list(jobs):
+                (done, status) = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    reply(jobs.pop(pid), status)
+    finally:
+        listener.close()
+        os.unlink(socket_path)
+        for conn in jobs.values():
+            conn.close()
+        # they stop their testbeds
+        for pid in holders:
+            os.kill(pid, signal.SIGTERM)
+        for pid in holders:
+            os.waitpid(pid, 0)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def cli_parser():
+    parser = argparse.ArgumentParser(
+        prog='reprotestd',
+        usage='''%(prog)s [options] [-- <virtual_server_args> [<virtual_server_args> ...]]''',
+        description='Keep testbeds open for `reprotest --remote` runs.')
+    parser.add_argument('--socket', default=default_socket_path(), metavar='PATH',
+        help='Unix socket to listen on. Default: %(default)s')
+    parser.add_argument('--pool-size', default=1, type=int, metavar='NUM',
+        help='Number of testbeds to keep open, i.e. the number of jobs that '
+        'can run on a warm testbed at the same time; further jobs start their '
+        'own testbed, like reprotest does without --remote. Default: %(default)s')
+    parser.add_argument('--testbed-init', default=None, metavar='COMMANDS',
+        help='Shell commands to run once when opening each testbed. Jobs only '
+        'use a warm testbed if they give the same --testbed-init.')
+    parser.add_argument('--host-distro', default=None,
+        help='The distribution that will run the tests (Default: %(default)s)')
+    parser.add_argument('--verbosity', type=int, default=0,
+        help='An integer.  Control which messages are displayed.')
+    parser.add_argument('virtual_server_args', default=['null'], nargs='*',
+        help='Arguments to pass to the virtual_server, the same as for reprotest. '
+        'Jobs only use a warm testbed if they give the same arguments.')
+    return parser
+
+
+def main():
+    args = cli_parser().parse_args(sys.argv[1:])
+    adtlog.verbosity = args.verbosity - 1
+    logging.basicConfig(level=30-10*args.verbosity)
+    serve(args.socket, args.pool_size, args.virtual_server_args or ['null'],
+          args.testbed_init, args.host_distro)
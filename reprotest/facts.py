@@ -0,0 +1,87 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Facts about testbeds, cached between runs.
+
+Opening a testbed probes it for its architecture, kernel, CPUs, installed
+packages and so on, see adt_testbed.Testbed.probe_facts(). Most of these only
+change with the image the testbed is started from, so with --cache-dir
+they are probed once per image and reused. The installed packages and the
+other adt_testbed.VOLATILE_FACTS can change in place, so they are left out
+and probed each time.
+"""
+
+import hashlib
+import json
+import os
+
+# change this when the facts probed by adt_testbed change
+VERSION = 1
+
+
+def image_key(virtual_server_args, host_distro=None):
+    """Identify the testbed image that virtual_server_args start.
+
+    Arguments that name files or directories, like a qemu image or a schroot
+    tarball, are identified by their size, mtime and inode as well, so the
+    key changes when they are replaced or updated. Other arguments, like the
+    names of containers, are only identified by name; delete the facts in
+    the cache dir after changing such a testbed in place.
+    """
+    h = hashlib.sha256(('%d %s\0' % (VERSION, host_distro or '')).encode())
+    for arg in virtual_server_args:
+        h.update(os.fsencode(arg) + b'\0')
+        try:
+            st = os.stat(arg)
+        except (OSError, ValueError):
+            continue
+        h.update(('%d %d %d\0' % (st.st_size, st.st_mtime_ns, st.st_ino)).encode())
+    return h.hexdigest()
+
+
+def is_file(arg):
+    try:
+        return os.path.isfile(arg)
+    except ValueError:
+        return False
+
+
+def facts_key(virtual_server_args, host_distro=None):
+    """Identify the facts of the testbed that virtual_server_args start.
+
+    Testbeds that are not started from an image file, like null, schroot or
+    named containers, share the kernel and CPUs of the host, which change
+    without image_key() changing: so for those the key includes the host,
+    its kernel and its number of CPUs as well.
+    """
+    key = image_key(virtual_server_args, host_distro)
+    if any(is_file(arg) for arg in virtual_server_args):
+        return key
+    host = os.uname()
+    return hashlib.sha256(('%s\0%s\0%s\0%s\0%d' % (
+        key, host.nodename, host.release, host.version, os.cpu_count() or 0)).encode()).hexdigest()
+
+
+class FactsCache(object):
+    """Testbed facts, stored as cache_dir/facts/<key>.json, except volatile ones."""
+
+    def __init__(self, cache_dir, volatile=()):
+        self.dir = os.path.join(cache_dir, 'facts')
+        self.volatile = volatile
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.dir, key + '.json')) as f:
+                facts = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # older versions cached them too
+        return dict((k, v) for (k, v) in facts.items() if k not in self.volatile)
+
+    def put(self, key, facts):
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, key + '.json')
+        temp = '%s.%d' % (path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(dict((k, v) for (k, v) in facts.items() if k not in self.volatile), f)
+        os.replace(temp, path)
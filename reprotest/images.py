@@ -0,0 +1,63 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Baked testbed images, with --testbed-init already applied.
+
+`reprotest bake` starts a testbed, runs --testbed-init in it and has the
+virtual server save the result as a derived image: a saved VM for qemu, a
+cloned container for lxc or a published image for lxd. The registry in
+cache_dir/images maps the base image (see facts.image_key()) and the init
+commands to the derived image, which later runs with the same --cache-dir
+start from instead of running --testbed-init again.
+
+The virtual servers get the image to save to as $REPROTEST_BAKE_TO, and the
+image to start from as $REPROTEST_BAKED_IMAGE; those that cannot bake
+images ignore both.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from reprotest import facts
+
+
+def image_key(virtual_server_args, testbed_init, host_distro=None):
+    """Identify the image that testbed_init makes from virtual_server_args."""
+    h = hashlib.sha256(facts.image_key(virtual_server_args, host_distro).encode() + b'\0')
+    h.update((testbed_init or '').encode())
+    return h.hexdigest()[:16]
+
+
+class ImageRegistry(object):
+    """Baked images, stored as cache_dir/images/<key>.json."""
+
+    def __init__(self, cache_dir):
+        self.dir = os.path.join(cache_dir, 'images')
+
+    def path(self, key):
+        """Where virtual servers that save to files put those of the image."""
+        return os.path.join(self.dir, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key) + '.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, image, virtual_server_args, testbed_init):
+        os.makedirs(self.dir, exist_ok=True)
+        path = self.path(key) + '.json'
+        temp = '%s.%d' % (path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump({'image': image, 'virtual_server_args': virtual_server_args,
+                       'testbed_init': testbed_init, 'baked': int(time.time())}, f)
+        os.replace(temp, path)
+
+    def remove(self, key):
+        try:
+            os.unlink(self.path(key) + '.json')
+        except FileNotFoundError:
+            pass
@@ -24,6 +24,8 @@ import __main__
 
 import sys
 import os
+import fcntl
+import functools
 from urllib.parse import quote as url_quote
 from urllib.parse import unquote as url_unquote
 import signal
@@ -32,8 +34,11 @@ import traceback
 import errno
 import time
 import pipes
+import re
+import selectors
 import socket
 import shutil
+import threading
 
 from reprotest.lib import adtlog
 
@@ -41,12 +46,21 @@ progname = "<VirtSubproc>"
 devnull_read = open('/dev/null', 'rb')
 caller = __main__
 copy_timeout = int(os.getenv('AUTOPKGTEST_VIRT_COPY_TIMEOUT', '300'))
+# (files, bytes, seconds, mode) of the last copyup/copydown
+last_transfer = None
+# [files, bytes] copied so far by the current copyup/copydown, counted by
+# copy_file() and count_tar_listing() as they go
+transferred = [0, 0]
 
 downtmp_open = None  # downtmp after opening testbed
 downtmp = None  # current downtmp (None after close)
 auxverb = None  # prefix to run command argv in testbed
 cleaning = False
 in_mainloop = False
+# what was read from stdin after the last command
+command_buf = bytearray()
+# how much of the output expect() returns
+expect_keep = 1 << 16
 
 
 class Quit(RuntimeError):
@@ -60,17 +74,48 @@ class Timeout(RuntimeError):
     pass
 
 
-def alarm_handler(*a):
-    raise Timeout()
+# the deadlines of the timeouts started in each thread, innermost last; these
+# are checked by the functions that wait for something, instead of using a
+# process-wide SIGALRM, so that several threads can each have their timeouts
+deadlines = threading.local()
 
 
 def timeout_start(to):
-    signal.signal(signal.SIGALRM, alarm_handler)
-    signal.alarm(to)
+    '''Start a timeout of to seconds (none if 0) in this thread
+
+    Timeouts nest, and the innermost must be stopped with timeout_stop(). While
+    they are active, execute_timeout(), expect(), sleep() etc. raise Timeout
+    once the earliest of their deadlines has passed.
+    '''
+    if not hasattr(deadlines, 'stack'):
+        deadlines.stack = []
+    deadlines.stack.append(time.monotonic() + to if to else None)
 
 
 def timeout_stop():
-    signal.alarm(0)
+    if getattr(deadlines, 'stack', None):
+        deadlines.stack.pop()
+
+
+def remaining_time():
+    '''Return the seconds until the earliest deadline of this thread
+
+    Return None if no timeout is active, and raise Timeout if it has passed.
+    '''
+    active = [d for d in getattr(deadlines, 'stack', ()) if d is not None]
+    if not active:
+        return None
+    left = min(active) - time.monotonic()
+    if left <= 0:
+        raise Timeout()
+    return left
+
+
+def sleep(secs):
+    '''time.sleep(), but raise Timeout once the deadline has passed'''
+    left = remaining_time()
+    time.sleep(secs if left is None else min(secs, left))
+    remaining_time()
 
 
 class FailedCmd(RuntimeError):
@@ -141,20 +186,21 @@ def execute_timeout(instr, timeout, *popenargs, **popenargsk):
                           **popenargsk)
     timeout_start(timeout)
     try:
-        (out, err) = sp.communicate(instr)
+        (out, err) = sp.communicate(instr, timeout=remaining_time())
         if out is not None:
             out = out.decode('UTF-8', 'replace')
         if err is not None:
             err = err.decode('UTF-8', 'replace')
-    except Timeout:
+    except (Timeout, subprocess.TimeoutExpired):
         try:
             sp.kill()
             sp.wait()
         except OSError as e:
             adtlog.error('WARNING: Cannot kill timed out process %s: %s' %
                          (popenargs[0], e))
-        raise
-    timeout_stop()
+        raise Timeout() from None
+    finally:
+        timeout_stop()
     status = sp.wait()
     return (status, out, err)
 
@@ -199,7 +245,9 @@ class timeout:
         '''Context manager that times out after given number of seconds.
 
         If exit_msg is given, the program bomb()s with that message,
-        otherwise it raises a Timeout exception.
+        otherwise it raises a Timeout exception. Like timeout_start(), this
+        only applies to this thread, and to what waits with the functions
+        here, like sleep() and expect(), instead of time.sleep() etc.
         '''
         self.secs = secs
         self.exit_msg = exit_msg
@@ -225,29 +273,44 @@ def get_unix_socket(path):
                 s.connect(path)
                 break
             except socket.error:
-                continue
+                sleep(0.01)
     return s
 
 
 def expect(sock, search_bytes, timeout_sec, description=None, echo=False):
+    '''Read from sock until search_bytes (or anything, if None) arrives
+
+    Return what was read, or only its last expect_keep bytes if it was
+    longer, like a boot log. Raise Timeout (or bomb() if a description is
+    given) if search_bytes does not arrive in time or sock is closed.
+    '''
     adtlog.debug('expect: "%s"' % (search_bytes or b'<none>').decode())
     what = '"%s"' % (description or search_bytes or 'data')
-    out = b''
+    out = bytearray()
     with timeout(timeout_sec,
-                 description and ('timed out waiting for %s' % what) or None):
+                 description and ('timed out waiting for %s' % what) or None), \
+            selectors.DefaultSelector() as sel:
+        sel.register(sock, selectors.EVENT_READ)
         while True:
-            block = sock.recv(4096)
+            if not sel.select(remaining_time()):
+                raise Timeout()
+            block = sock.recv(65536)
             if not block:
-                time.sleep(0.1)
-                continue
+                adtlog.debug('expect: connection closed')
+                raise Timeout()
             if echo:
                 sys.stderr.buffer.write(block)
+            # only search the new block, and the end of the old data in which
+            # a match could start
+            start = max(0, len(out) - len(search_bytes or b'') + 1)
             out += block
-            if search_bytes is None or search_bytes in out:
+            if search_bytes is None or out.find(search_bytes, start) >= 0:
                 adtlog.debug('expect: found "%s"' % what)
                 break
+            if len(out) > expect_keep:
+                del out[:len(out) - expect_keep]
 
-    return out
+    return bytes(out)
 
 
 def cmd_open(c, ce):
@@ -309,6 +372,36 @@ def cmd_revert(c, ce):
     return [downtmp]
 
 
+def cmd_snapshot(c, ce):
+    '''Save the current state of the testbed; `revert' then returns to it
+
+    Without a snapshot, `revert' returns to the state of the testbed when it
+    was opened.
+    '''
+    cmdnumargs(c, ce)
+    if not downtmp:
+        bomb("`snapshot' when not open")
+    if 'snapshot' not in caller.hook_capabilities():
+        bomb("`snapshot' when `snapshot' not advertised")
+    caller.hook_snapshot()
+
+
+def cmd_save_state(c, ce):
+    '''Save the state of the testbed, for the next sessions to start from
+
+    The caller does this once it has set up the testbed. Testbeds started
+    from a saved state advertise `restored-state' instead of `save-state'.
+    Returns the name of the saved state, which callers that bake images
+    (see $REPROTEST_BAKE_TO) pass back as $REPROTEST_BAKED_IMAGE.
+    '''
+    cmdnumargs(c, ce)
+    if not downtmp:
+        bomb("`save-state' when not open")
+    if 'save-state' not in caller.hook_capabilities():
+        bomb("`save-state' when `save-state' not advertised")
+    return [url_quote(caller.hook_save_state())]
+
+
 def cmd_reboot(c, ce):
     global downtmp
     cmdnumargs(c, ce, 0, 1)
@@ -361,17 +454,102 @@ def get_downtmp_host():
     return None
 
 
-def copytree(src, dst):
-    '''Like shutils.copytree(), but merges with existing dst'''
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
 
+
+def reflink_file(fsrc, fdst):
+    '''Make fdst share the data blocks of fsrc (both open file objects)
+
+    Return False if the filesystem does not support reflinks (or src and dst
+    are on different filesystems).
+    '''
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def copy_file_range(fsrc, fdst):
+    '''Copy fsrc to fdst in the kernel, with copy_file_range(2)
+
+    This avoids copying the data through user space, and lets NFS and some
+    other filesystems do server-side copies. Return False if this is not
+    supported, in which case the files are rewound to their start.
+    '''
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    try:
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+            pass
+        return True
+    except OSError:
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        return False
+
+
+def copy_file(src, dst, hardlink=False):
+    '''Copy a file as cheaply as the filesystem allows
+
+    Symlinks are copied as symlinks. If hardlink is True, regular files are
+    hardlinked; only ask for this if dst is never modified, as it shares its
+    inode with src. Otherwise try a reflink, then copy_file_range(2), and only
+    then copy the bytes. Permissions and timestamps are preserved.
+    '''
+    # copies of big trees are checked against the copy timeout file by file
+    remaining_time()
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        shutil.copystat(src, dst, follow_symlinks=False)
+        return
+    if hardlink:
+        try:
+            os.link(src, dst)
+            transferred[0] += 1
+            transferred[1] += os.lstat(dst).st_size
+            return
+        except OSError as e:
+            adtlog.debug('copy_file: cannot hardlink %s: %s' % (src, e))
+    with open(src, 'rb', buffering=0) as fsrc:
+        with open(dst, 'wb', buffering=0) as fdst:
+            if not reflink_file(fsrc, fdst) and not copy_file_range(fsrc, fdst):
+                shutil.copyfileobj(fsrc, fdst, 1 << 20)
+        transferred[0] += 1
+        transferred[1] += os.fstat(fsrc.fileno()).st_size
+    shutil.copystat(src, dst)
+
+
+def copytree(src, dst, hardlink=False):
+    '''Like shutils.copytree(), but merges with existing dst
+
+    Files are copied with copy_file(), see there for the hardlink argument.
+    Directories get the permissions and timestamps of those in src, like
+    cp --preserve=timestamps does, also when they exist in dst already.
+    '''
+    copy_function = functools.partial(copy_file, hardlink=hardlink)
     if not os.path.exists(dst):
-        shutil.copytree(src, dst, symlinks=True)
+        shutil.copytree(src, dst, symlinks=True, copy_function=copy_function)
         return
 
     for f in os.listdir(src):
         fsrc = os.path.join(src, f)
-        subprocess.check_call(['cp', '-r', '--preserve=timestamps,links',
-                               '--target-directory', dst, fsrc])
+        fdst = os.path.join(dst, f)
+        if os.path.isdir(fsrc) and not os.path.islink(fsrc):
+            if os.path.lexists(fdst) and not os.path.isdir(fdst):
+                os.unlink(fdst)
+            copytree(fsrc, fdst, hardlink)
+        else:
+            if os.path.isdir(fdst) and not os.path.islink(fdst):
+                raise shutil.Error('cannot overwrite directory %s with '
+                                   'non-directory %s' % (fdst, fsrc))
+            if os.path.lexists(fdst):
+                os.unlink(fdst)
+            copy_file(fsrc, fdst, hardlink)
+    # after its contents, which change its mtime
+    shutil.copystat(src, dst)
 
 
 def copyup_shareddir(tb, host, is_dir, downtmp_host):
@@ -392,8 +570,8 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
             tb_tmp = os.path.join(downtmp, os.path.basename(host))
             adtlog.debug('copyup_shareddir: tb path %s is not already in '
                          'downtmp, copying to %s' % (tb, tb_tmp))
-            check_exec(['cp', '-r', '--preserve=timestamps,links', tb, tb_tmp],
-                       downp=True)
+            check_exec(['cp', '-r', '--reflink=auto',
+                        '--preserve=timestamps,links', tb, tb_tmp], downp=True)
             # translate into host path
             tb = os.path.join(downtmp_host, os.path.basename(host))
 
@@ -405,7 +583,9 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
             if is_dir:
                 copytree(tb, host)
             else:
-                shutil.copy(tb, host)
+                if os.path.lexists(host):
+                    os.unlink(host)
+                copy_file(tb, host)
 
         if tb_tmp:
             adtlog.debug('copyup_shareddir: rm intermediate copy: %s' % tb)
@@ -430,6 +610,10 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
             host = downtmp + host[len(downtmp_host):]
         else:
             host_tmp = os.path.join(downtmp_host, os.path.basename(tb))
+            # the staging copy is only read by the cp below and then removed,
+            # so it may share inodes with host; unless it already is the
+            # final destination, which the testbed is free to modify
+            hardlink = os.path.join(downtmp, os.path.basename(tb)) != tb
             if is_dir:
                 if os.path.exists(host_tmp):
                     try:
@@ -446,9 +630,11 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
                                 break
                             counter += 1
 
-                shutil.copytree(host, host_tmp, symlinks=True)
+                copytree(host, host_tmp, hardlink)
             else:
-                shutil.copy(host, host_tmp)
+                if os.path.lexists(host_tmp):
+                    os.unlink(host_tmp)
+                copy_file(host, host_tmp, hardlink)
             # translate into tb path
             host = os.path.join(downtmp, os.path.basename(tb))
 
@@ -456,25 +642,163 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
             host_tmp = None
         else:
             check_exec(['rm', '-rf', tb], downp=True)
-            check_exec(['cp', '-r', '--preserve=timestamps,links', host, tb],
-                       downp=True)
+            check_exec(['cp', '-r', '--reflink=auto',
+                        '--preserve=timestamps,links', host, tb], downp=True)
         if host_tmp:
             (is_dir and shutil.rmtree or os.unlink)(host_tmp)
     finally:
         timeout_stop()
 
 
+def expand_pattern(directory, pattern):
+    '''Return the paths matching the shell globs in a host directory
+
+    Like the shell, globs which match nothing are returned as they are.
+    '''
+    out = check_exec(['sh', '-ec', 'cd "$0"; for f in %s; do '
+                      'printf "%%s\\0" "$f"; done' % pattern, directory],
+                     outp=True)
+    return out.split('\0')[:-1]
+
+
+# a member in the output of tar -vv: mode, owner, size, date, time, name
+TAR_LISTING = re.compile(rb'([-hlcbpdD])[-rwxsStT]{9} +\S+ +(\S+) +\S+ +\S+ ')
+
+
+def count_tar_listing(f):
+    '''Add the regular files in the tar -vv listing read from f to transferred
+
+    Other lines, like errors, are passed on to stderr.
+    '''
+    for line in f:
+        m = TAR_LISTING.match(line)
+        if not m:
+            sys.stderr.buffer.write(line)
+            sys.stderr.flush()
+        elif m.group(1) in b'-h':
+            transferred[0] += 1
+            transferred[1] += int(m.group(2)) if m.group(2).isdigit() else 0
+
+
+def pattern_dest(path, dst):
+    '''Return where a path matched by a copy pattern goes under dst
+
+    Matches keep their path relative to the source directory. Leading ../
+    components are resolved against dst, but never above the parent of dst
+    (tar strips them in the same way).
+    '''
+    parts = os.path.normpath(path).split(os.sep)
+    if parts[0] != '..':
+        return os.path.join(dst, *parts)
+    while parts and parts[0] == '..':
+        parts.pop(0)
+    return os.path.join(os.path.dirname(dst), *parts)
+
+
+def copyup_shareddir_pattern(tb, host, pattern, downtmp_host):
+    adtlog.debug('copyup_shareddir_pattern: tb %s host %s pattern %s '
+                 'downtmp_host %s' % (tb, host, pattern, downtmp_host))
+
+    host = os.path.normpath(host)
+    tb = os.path.normpath(tb)
+    downtmp_host = os.path.normpath(downtmp_host)
+    if not tb.startswith(downtmp):
+        raise shutil.Error('%s is not in downtmp' % tb)
+    # translate into host path
+    tb = downtmp_host + tb[len(downtmp):]
+
+    timeout_start(copy_timeout)
+    try:
+        paths = expand_pattern(tb, pattern)
+        copy_pattern('copyup', tb, host, paths)
+    finally:
+        timeout_stop()
+
+
+def copydown_shareddir_pattern(host, tb, pattern, downtmp_host):
+    adtlog.debug('copydown_shareddir_pattern: host %s tb %s pattern %s '
+                 'downtmp_host %s' % (host, tb, pattern, downtmp_host))
+
+    host = os.path.normpath(host)
+    tb = os.path.normpath(tb)
+    downtmp_host = os.path.normpath(downtmp_host)
+
+    paths = expand_pattern(host, pattern)
+    host_tmp = os.path.join(downtmp_host, os.path.basename(tb))
+    # like in copydown_shareddir(), the matches can go straight to their
+    # destination if that is in downtmp; otherwise they are staged there and
+    # copied by the testbed, and the staging copy may share inodes with host
+    direct = os.path.join(downtmp, os.path.basename(tb)) == tb
+    timeout_start(copy_timeout)
+    try:
+        if not direct and os.path.exists(host_tmp):
+            shutil.rmtree(host_tmp)
+        copy_pattern('copydown', host, host_tmp, paths, not direct)
+        if not direct:
+            check_exec(['mkdir', '-p', tb], downp=True)
+            check_exec(['cp', '-r', '--reflink=auto',
+                        '--preserve=timestamps,links',
+                        os.path.join(downtmp, os.path.basename(tb), '.'), tb],
+                       downp=True)
+            shutil.rmtree(host_tmp)
+    finally:
+        timeout_stop()
+
+
+def copy_pattern(wh, src, dst, paths, hardlink=False):
+    '''Copy paths matched by a pattern in src to dst, see pattern_dest()'''
+    os.makedirs(dst, exist_ok=True)
+    for path in paths:
+        fsrc = os.path.join(src, path)
+        fdst = pattern_dest(path, dst)
+        if not os.path.lexists(fsrc):
+            bomb('%s: %s does not exist' % (wh, fsrc))
+        if os.path.isdir(fsrc) and not os.path.islink(fsrc):
+            copytree(fsrc, fdst, hardlink)
+        else:
+            os.makedirs(os.path.dirname(fdst), exist_ok=True)
+            if os.path.lexists(fdst):
+                os.unlink(fdst)
+            copy_file(fsrc, fdst, hardlink)
+
+
 def copyupdown(c, ce, upp):
-    cmdnumargs(c, ce, 2)
-    copyupdown_internal(ce[0], c[1:], upp)
+    cmdnumargs(c, ce, 2, 1)
+    copyupdown_internal(ce[0], c[1:3], upp, len(c) > 3 and c[3] or None)
 
 
-def copyupdown_internal(wh, sd, upp):
+def copyupdown_internal(wh, sd, upp, pattern=None):
     '''Copy up/down a file or dir.
 
     wh: 'copyup' or 'copydown'
     sd: (source, destination) paths
     upp: True for copyup, False for copydown
+    pattern: if given, only copy the paths in the source directory that
+             match these shell globs, each starting with ./ (see
+             pattern_dest() for where they go); when copying down, they
+             must not match anything outside of the source directory
+
+    The size, duration and mode of the transfer are kept for the
+    transfer-stats command. The size counts the regular files that the host
+    copied or that went through tar; what the testbed copies by itself from
+    its shared dir is not counted.
+    '''
+    global last_transfer
+
+    start = time.time()
+    transferred[:] = [0, 0]
+    mode = copyupdown_transfer(wh, sd, upp, pattern)
+    seconds = time.time() - start
+    (nfiles, nbytes) = transferred
+    last_transfer = (nfiles, nbytes, seconds, mode)
+    adtlog.debug('%s: %i files, %i bytes in %.3fs via %s' %
+                 (wh, nfiles, nbytes, seconds, mode))
+
+
+def copyupdown_transfer(wh, sd, upp, pattern):
+    '''Do the work of copyupdown_internal()
+
+    Return how the files were transferred: "shared-dir" or "tar".
     '''
     if not downtmp:
         bomb("%s when not open" % wh)
@@ -484,17 +808,27 @@ def copyupdown_internal(wh, sd, upp):
     if dirsp != (sd[1][-1] == '/'):
         bomb("%s paths must agree about directoryness"
              " (presence or absence of trailing /)" % wh)
+    if pattern and not dirsp:
+        bomb("%s pattern needs directory paths" % wh)
+    if pattern and not upp:
+        for path in expand_pattern(sd[0], pattern):
+            if os.path.normpath(path).startswith('..'):
+                bomb("%s pattern matches %s outside of %s" % (wh, path, sd[0]))
 
     # if we have a shared directory, we just need to copy it from/to there; in
     # most cases, it's testbed end is already in the downtmp dir
     downtmp_host = get_downtmp_host()
     if downtmp_host:
         try:
-            if upp:
+            if pattern and upp:
+                copyup_shareddir_pattern(sd[0], sd[1], pattern, downtmp_host)
+            elif pattern:
+                copydown_shareddir_pattern(sd[0], sd[1], pattern, downtmp_host)
+            elif upp:
                 copyup_shareddir(sd[0], sd[1], dirsp, downtmp_host)
             else:
                 copydown_shareddir(sd[0], sd[1], dirsp, downtmp_host)
-            return
+            return 'shared-dir'
         except Timeout:
             raise FailedCmd(['timeout'])
         except (shutil.Error, subprocess.CalledProcessError) as e:
@@ -516,17 +850,34 @@ def copyupdown_internal(wh, sd, upp):
         else:
             srcstdin = open(sd[isrc], 'rb')
             status = os.fstat(srcstdin.fileno())
+            transferred[:] = [1, status.st_size]
             if status.st_mode & 0o111:
                 rune += '; chmod +x -- %s' % (remfileq)
         localcmdl = ['cat']
     else:
         taropts = [None, None]
-        taropts[isrc] = '--warning=none -c .'
+        taropts[isrc] = '--warning=none -c' + (not pattern and ' .' or '')
         taropts[idst] = '--warning=none --preserve-permissions --extract ' \
                         '--no-same-owner'
 
         rune = 'cd %s; tar %s -f -' % (remfileq, taropts[iremote])
-        if upp:
+        localdir = sd[ilocal]
+        localpaths = []
+        if pattern and not upp:
+            localpaths = expand_pattern(localdir, pattern)
+            rune = ('mkdir -p -- %s; ' % remfileq) + rune
+        elif pattern:
+            # put matches under the basename of the destination and extract
+            # in its parent, so that matches in ../ end up there
+            localdir = os.path.normpath(sd[ilocal])
+            base = os.path.basename(localdir)
+            for c in '\\,&':
+                base = base.replace(c, '\\' + c)
+            rune += ' %s %s' % (
+                pipes.quote('--transform=s,^\\./,%s/,' % base), pattern)
+            os.makedirs(localdir, exist_ok=True)
+            localdir = os.path.dirname(localdir)
+        elif upp:
             try:
                 os.mkdir(sd[ilocal])
             except (IOError, OSError) as oe:
@@ -537,9 +888,10 @@ def copyupdown_internal(wh, sd, upp):
                 remfileq, remfileq)
             ) + rune
 
-        localcmdl = ['tar', '--directory', sd[ilocal]] + (
+        # the listing is for count_tar_listing()
+        localcmdl = ['tar', '--directory', localdir, '-vv'] + (
             ('%s -f -' % taropts[ilocal]).split()
-        )
+        ) + localpaths
     downcmdl = auxverb + ['sh', '-ec', rune]
 
     if upp:
@@ -551,29 +903,44 @@ def copyupdown_internal(wh, sd, upp):
     adtlog.debug(str(["srcstdin", str(srcstdin), "deststdout",
                       str(deststdout), "devnull_read", devnull_read]))
 
+    # tar lists the files on stderr when creating the archive on stdout,
+    # otherwise on stdout
+    listing = dirsp and subprocess.PIPE or None
     subprocs = [None, None]
     adtlog.debug(" +< %s" % ' '.join(cmdls[0]))
     subprocs[0] = subprocess.Popen(cmdls[0], stdin=srcstdin,
-                                   stdout=subprocess.PIPE)
+                                   stdout=subprocess.PIPE,
+                                   stderr=None if upp else listing)
     adtlog.debug(" +> %s" % ' '.join(cmdls[1]))
     subprocs[1] = subprocess.Popen(cmdls[1], stdin=subprocs[0].stdout,
-                                   stdout=deststdout)
+                                   stdout=upp and listing or deststdout)
     subprocs[0].stdout.close()
+    counter = None
+    if listing:
+        counter = threading.Thread(target=count_tar_listing, args=(
+            upp and subprocs[1].stdout or subprocs[0].stderr,))
+        counter.daemon = True
+        counter.start()
+    timeout_start(copy_timeout)
     try:
-        timeout_start(copy_timeout)
         for sdn in [1, 0]:
             adtlog.debug(" +" + "<>"[sdn] + "?")
-            status = subprocs[sdn].wait()
+            status = subprocs[sdn].wait(remaining_time())
             if not (status == 0 or (sdn == 0 and status == -13)):
-                timeout_stop()
                 bomb("%s %s failed, status %d" %
                      (wh, ['source', 'destination'][sdn], status))
-        timeout_stop()
-    except Timeout:
+    except (Timeout, subprocess.TimeoutExpired):
         for sdn in [1, 0]:
             subprocs[sdn].kill()
             subprocs[sdn].wait()
         raise FailedCmd(['timeout'])
+    finally:
+        timeout_stop()
+    if counter:
+        counter.join()
+    elif upp:
+        transferred[:] = [1, os.fstat(deststdout.fileno()).st_size]
+    return 'tar'
 
 
 def cmd_copydown(c, ce):
@@ -584,6 +951,14 @@ def cmd_copyup(c, ce):
     copyupdown(c, ce, True)
 
 
+def cmd_transfer_stats(c, ce):
+    cmdnumargs(c, ce)
+    if not last_transfer:
+        bomb("`transfer-stats' before any copyup or copydown")
+    (nfiles, nbytes, seconds, mode) = last_transfer
+    return [str(nfiles), str(nbytes), '%.3f' % seconds, mode]
+
+
 def cmd_shell(c, ce):
     cmdnumargs(c, ce, 1, None)
     if not downtmp:
@@ -612,24 +987,36 @@ def cmd_shell(c, ce):
             adtlog.error('Cannot run shell: %s' % e)
 
 
-def command():
-    sys.stdout.flush()
-    while True:
-        try:
-            ce = sys.stdin.readline().strip()
-            # FIXME: This usually means EOF (as checked below), but with Python
-            # 3 we often get empty strings here even though this is supposed to
-            # block for new input.
-            if ce == '':
-                time.sleep(0.1)
+def read_command(fd):
+    '''Return the next non-empty line from fd, or None at end of file
+
+    This waits for input with select(), as fd may have been left in
+    non-blocking mode by some command that shares it.
+    '''
+    global command_buf
+
+    with selectors.DefaultSelector() as sel:
+        sel.register(fd, selectors.EVENT_READ)
+        while True:
+            (line, nl, rest) = command_buf.partition(b'\n')
+            if nl:
+                command_buf = rest
+                if line.strip():
+                    return line.decode().strip()
                 continue
-            break
-        except IOError as e:
-            if e.errno == errno.EAGAIN:
-                time.sleep(0.1)
+            try:
+                block = os.read(fd, 4096)
+            except BlockingIOError:
+                sel.select()
                 continue
-            else:
-                raise
+            if not block:
+                return None
+            command_buf += block
+
+
+def command():
+    sys.stdout.flush()
+    ce = read_command(sys.stdin.fileno())
     if not ce:
         bomb('end of file - caller quit?')
     ce = ce.rstrip().split()
@@ -31,6 +31,7 @@ import signal
 import subprocess
 import tempfile
 import shutil
+import types
 import distro
 import urllib.parse
 
@@ -50,11 +51,17 @@ SYSTEM_INTERFACES = {
 timeouts = {'short': 100, 'copy': 300, 'install': 3000, 'test': 10000,
             'build': 100000}
 
+# starts the output of each probe in Testbed.probe_facts()
+FACT_MARKER = '@@autopkgtest-fact'
+# facts that can change without the testbed image changing, e.g. when a
+# named container is upgraded in place; caches must not keep them
+VOLATILE_FACTS = ('eatmydata', 'packages')
+
 
 class Testbed:
     def __init__(self, vserver_argv, output_dir, user,
                  setup_commands=[], setup_commands_boot=[], add_apt_pockets=[],
-                 copy_files=[], host_distro=None):
+                 copy_files=[], host_distro=None, env=None):
         self.sp = None
         self.lastsend = None
         self.scratch = None
@@ -66,6 +73,7 @@ class Testbed:
         self.output_dir = output_dir
         self.shared_downtmp = None  # testbed's downtmp on the host, if supported
         self.vserver_argv = vserver_argv
+        self.vserver_env = env  # None inherits ours
         self.install_tmp_env = []
         self.user = user
         self.setup_commands = setup_commands
@@ -83,6 +91,8 @@ class Testbed:
         self.nproc = None
         self.cpu_model = None
         self.cpu_flags = None
+        # see probe_facts(); may be set before open(), e.g. from a cache
+        self.facts = None
 
         try:
             self.devnull = subprocess.DEVNULL
@@ -126,6 +136,7 @@ class Testbed:
         self.sp = subprocess.Popen(self.vserver_argv,
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE,
+                                   env=self.vserver_env,
                                    universal_newlines=True)
         self.expect('ok', 0)
 
@@ -185,8 +196,12 @@ class Testbed:
                           ''' '> /tmp/autopkgtest-reboot-prepare;'''
                           '''chmod 755 /tmp/autopkgtest-reboot-prepare;'''])
 
-        # record running kernel version
-        kver = self.check_exec(['uname', '-srv'], True).strip()
+        # record running kernel version; for the first boot, it was probed
+        # together with the other facts
+        if self.initial_kernel_version:
+            kver = self.check_exec(['uname', '-srv'], True).strip()
+        else:
+            kver = self.facts['kernel'].strip()
         if not self.initial_kernel_version:
             assert not self.last_test_name
             self.initial_kernel_version = kver
@@ -200,9 +215,8 @@ class Testbed:
 
         # get CPU info
         if self.nproc is None:
-            cpu_info = self.check_exec(['sh', '-c', 'nproc; cat /proc/cpuinfo 2>/dev/null || true'],
-                                       stdout=True).strip()
-            self.nproc = cpu_info.split('\n', 1)[0]
+            cpu_info = self.facts['cpuinfo']
+            self.nproc = self.facts['nproc'].strip()
             m = re.search('^(model.*name|cpu)\s*:\s*(.*)$', cpu_info, re.MULTILINE | re.IGNORECASE)
             if m:
                 self.cpu_model = m.group(2)
@@ -245,25 +259,68 @@ class Testbed:
                     self.user = c.split('=', 1)[1]
 
         self.run_setup_commands()
+        self.probe_facts()
 
         # determine testbed architecture
-        self.system_arch = self.check_exec(self.system_interface.get_arch(), True).strip()
+        self.system_arch = self.facts['arch'].strip()
+        if not self.system_arch:
+            self.bomb('"%s" did not print the testbed architecture' %
+                      ' '.join(self.system_interface.get_arch()))
         adtlog.info('testbed package architecture: ' + self.system_arch)
 
         # do we have eatmydata?
-        (code, out, err) = self.execute(['which', 'eatmydata'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if code == 0:
+        if self.facts['eatmydata'].strip():
             adtlog.debug('testbed has eatmydata')
-            self.eatmydata_prefix = [out.strip()]
+            self.eatmydata_prefix = [self.facts['eatmydata'].strip()]
 
         # record package versions of pristine testbed
-        if self.output_dir and self.system_interface.can_query_packages():
-            pkglist = TempPath(self, 'testbed-packages', autoclean=False)
-            self.check_exec(self.system_interface.get_installed_packages(pkglist))
-            pkglist.copyup()
+        if 'packages' in self.facts:
+            with open(os.path.join(self.output_dir, 'testbed-packages'), 'w') as f:
+                f.write(self.facts['packages'])
 
         self.post_boot_setup()
 
+    def probe_facts(self):
+        '''Find out what the testbed is like, unless self.facts has it already
+
+        Everything that opening the testbed needs to know is found out with
+        one batched command, instead of one command each, and stored as a
+        dict of their outputs in self.facts. The facts already in it
+        beforehand, e.g. from a cache of an identical testbed, are not probed
+        again.
+        '''
+        known = self.facts or {}
+        probes = [
+            ('arch', self.system_interface.get_arch()),
+            ('eatmydata', ['which', 'eatmydata']),
+            ('kernel', ['uname', '-srv']),
+            ('machine', ['uname', '-m']),
+            ('kernel-release', ['uname', '-r']),
+            ('nproc', ['nproc']),
+            ('cpuinfo', ['cat', '/proc/cpuinfo']),
+            ('setarch', ['setarch', '--list']),
+        ]
+        if self.output_dir and self.system_interface.can_query_packages():
+            probes.append(('packages', self.system_interface.get_installed_packages(
+                types.SimpleNamespace(tb='/dev/stdout'))))
+        probes = [(name, argv) for (name, argv) in probes if name not in known]
+        if not probes:
+            self.facts = known
+            return
+        script = ''.join("echo '%s %s'; %s 2>/dev/null\n" % (
+            FACT_MARKER, name, ' '.join(pipes.quote(a) for a in argv)) for (name, argv) in probes)
+        out = self.check_exec(['sh', '-c', script + 'true'], stdout=True)
+
+        lines = dict((name, []) for (name, argv) in probes)
+        name = None
+        for line in out.splitlines(True):
+            if line.startswith(FACT_MARKER + ' '):
+                name = line.split(' ', 1)[1].strip()
+            elif name:
+                lines[name].append(line)
+        self.facts = dict(known)
+        self.facts.update((name, ''.join(l)) for (name, l) in lines.items())
+
     def close(self):
         adtlog.debug('testbed close, scratch=%s' % self.scratch)
         if self.scratch is None:
@@ -429,42 +486,32 @@ class Testbed:
             ll = list(map(urllib.parse.unquote, ll))
         return ll
 
-    def execute(self, argv, xenv=[], stdout=None, stderr=None, kind='short'):
+    def execute(self, argv, xenv=[], stdout=None, stderr=None, kind='short',
+                stdin=None):
         '''Run command in testbed.
 
         The commands stdout/err will be piped directly to autopkgtest and its log
         files, unless redirection happens with the stdout/stderr arguments
-        (passed to Popen).
+        (passed to Popen). Its stdin is /dev/null unless given.
 
         Return (exit code, stdout, stderr). stdout/err will be None when output
         is not redirected.
         '''
-        env = list(xenv)  # copy
-        if kind == 'install':
-            env.append('DEBIAN_FRONTEND=noninteractive')
-            env.append('APT_LISTBUGS_FRONTEND=none')
-            env.append('APT_LISTCHANGES_FRONTEND=none')
-        env += self.install_tmp_env
-
-        adtlog.debug('testbed command %s, kind %s, sout %s, serr %s, env %s' %
+        argv = self.env_argv(argv, xenv, kind)
+        adtlog.debug('testbed command %s, kind %s, sout %s, serr %s' %
                      (argv, kind, stdout and 'pipe' or 'raw',
-                      stderr and 'pipe' or 'raw', env))
-
-        if env:
-            argv = ['env'] + env + argv
+                      stderr and 'pipe' or 'raw'))
 
-        VirtSubproc.timeout_start(timeouts[kind])
+        proc = subprocess.Popen(self.exec_cmd + argv,
+                                stdin=stdin or self.devnull,
+                                stdout=stdout, stderr=stderr)
         try:
-            proc = subprocess.Popen(self.exec_cmd + argv,
-                                    stdin=self.devnull,
-                                    stdout=stdout, stderr=stderr)
-            (out, err) = proc.communicate()
+            (out, err) = proc.communicate(timeout=timeouts[kind])
             if out is not None:
                 out = out.decode()
             if err is not None:
                 err = err.decode()
-            VirtSubproc.timeout_stop()
-        except VirtSubproc.Timeout:
+        except subprocess.TimeoutExpired:
             # This is a bit of a hack, but what can we do.. we can't kill/clean
             # up sudo processes, we can only hope that they clean up themselves
             # after we stop the testbed
@@ -475,7 +522,7 @@ class Testbed:
             msg = 'timed out on command "%s" (kind: %s)' % (' '.join(argv), kind)
             if kind == 'test':
                 adtlog.error(msg)
-                raise
+                raise VirtSubproc.Timeout() from None
             else:
                 self.bomb(msg)
 
@@ -487,6 +534,18 @@ class Testbed:
 
         return (proc.returncode, out, err)
 
+    def env_argv(self, argv, xenv=[], kind='short'):
+        '''Return argv run with the environment for execute()'''
+        env = list(xenv)  # copy
+        if kind == 'install':
+            env.append('DEBIAN_FRONTEND=noninteractive')
+            env.append('APT_LISTBUGS_FRONTEND=none')
+            env.append('APT_LISTCHANGES_FRONTEND=none')
+        env += self.install_tmp_env
+        if env:
+            argv = ['env'] + env + argv
+        return argv
+
     def check_exec(self, argv, stdout=False, kind='short'):
         '''Run argv in testbed.
 
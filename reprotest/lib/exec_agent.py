@@ -0,0 +1,471 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+'''Command execution agent for testbeds
+
+The agent runs inside the testbed and runs commands for the host over a
+single stream: its stdin/stdout, or a vsock connection. Everything on the
+stream is a frame of (request id, type, payload), so several commands can
+run at the same time with their input and output interleaved.
+
+The agent runs commands as the user it runs as, root for the virtual
+servers, for anyone who can talk to it. Over stdin/stdout that is only
+whoever started it. A vsock port can be connected to from the host by any
+user, so in vsock mode each connection must start with the token that the
+agent got in $REPROTEST_AGENT_TOKEN (see new_token()), which the host passes
+through a private channel such as the serial console; the agent closes
+connections without it. The frames themselves are neither authenticated nor
+encrypted, which is fine for a local vsock connection.
+
+This file is also copied into testbeds and run there as a script, so it must
+only use the Python standard library and work with old Python 3 versions.
+'''
+
+import binascii
+import errno
+import fcntl
+import hmac
+import os
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+HEADER = struct.Struct('!IBI')
+# frame types; EXEC, STDIN and KILL go to the agent, the others come back
+EXEC, STDIN, STDOUT, STDERR, EXIT, KILL = range(1, 7)
+BLOCK = 1 << 18
+# how long Client.run() waits for a killed command to exit, before it gives
+# up on the agent (e.g. the command is stuck in the kernel, or the agent hangs)
+KILL_WAIT = 10
+
+# the vsock token: hexadecimal, so that it can be passed through shells
+TOKEN_SIZE = 32
+
+# unlike epoll, these also work with /dev/null and regular files
+Selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def send_frame(fd, req, typ, payload=b''):
+    write_all(fd, HEADER.pack(req, typ, len(payload)) + payload)
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class FrameWriter(object):
+    '''Send frames to fd from a thread, so that the sender never blocks
+
+    Otherwise both ends could block on writing to each other, when the
+    commands' output fills the buffers while stdin is still being sent.
+    '''
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            send_frame(self.fd, *frame)
+
+    def send(self, req, typ, payload=b''):
+        self.queue.put((req, typ, payload))
+
+    def close(self):
+        '''Wait until all frames are sent'''
+        self.queue.put(None)
+        self.thread.join()
+
+
+class FrameReader(object):
+    '''Split the bytes read from a stream into frames'''
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        '''Add data; return the list of (req, type, payload) now complete'''
+        self.buf += data
+        frames = []
+        while len(self.buf) >= HEADER.size:
+            (req, typ, size) = HEADER.unpack_from(self.buf)
+            end = HEADER.size + size
+            if len(self.buf) < end:
+                break
+            frames.append((req, typ, bytes(self.buf[HEADER.size:end])))
+            del self.buf[:end]
+        return frames
+
+
+class Job(object):
+    '''A command run by the agent'''
+
+    def __init__(self, req, argv):
+        self.req = req
+        self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     start_new_session=True)
+        for f in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            set_nonblocking(f.fileno())
+        self.stdin_buf = bytearray()
+        self.stdin_eof = False
+        self.stdin_registered = False
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def serve(rfd, wfd):
+    '''Run commands as requested by the frames from rfd, replying to wfd
+
+    Return when rfd is closed, killing the commands that are still running.
+
+    A command is finished when its process exits, even if processes that it
+    started still have its stdout or stderr open; threads wait for the
+    processes, and write the request ids of those that exited to a pipe.
+    '''
+    sel = Selector()
+    sel.register(rfd, selectors.EVENT_READ)
+    (exited_r, exited_w) = os.pipe()
+    sel.register(exited_r, selectors.EVENT_READ)
+    reader = FrameReader()
+    writer = FrameWriter(wfd)
+    jobs = {}
+
+    def wait(job):
+        job.proc.wait()
+        # at most PIPE_BUF, so written at once
+        os.write(exited_w, struct.pack('!I', job.req))
+
+    def close_output(job, f, typ):
+        '''Send what is left in output f, and close it'''
+        while True:
+            try:
+                data = os.read(f.fileno(), BLOCK)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            writer.send(job.req, typ, data)
+        sel.unregister(f)
+        f.close()
+
+    def finish(job):
+        for (f, typ) in ((job.proc.stdout, STDOUT), (job.proc.stderr, STDERR)):
+            if not f.closed:
+                close_output(job, f, typ)
+        job.stdin_buf = bytearray()
+        job.stdin_eof = True
+        update_stdin(job)
+        rc = job.proc.returncode
+        # like the shell does for commands killed by a signal
+        if rc < 0:
+            rc = 128 - rc
+        writer.send(job.req, EXIT, str(rc).encode())
+        del jobs[job.req]
+
+    def update_stdin(job):
+        stdin = job.proc.stdin
+        if not stdin.closed:
+            try:
+                while job.stdin_buf:
+                    del job.stdin_buf[:os.write(stdin.fileno(), job.stdin_buf)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                # EPIPE: the command does not read its stdin (any more)
+                job.stdin_buf = bytearray()
+                job.stdin_eof = True
+        if bool(job.stdin_buf) != job.stdin_registered:
+            if job.stdin_buf:
+                sel.register(stdin, selectors.EVENT_WRITE, job)
+            else:
+                sel.unregister(stdin)
+            job.stdin_registered = bool(job.stdin_buf)
+        if job.stdin_eof and not job.stdin_buf and not stdin.closed:
+            stdin.close()
+
+    def handle(req, typ, payload):
+        if typ == EXEC:
+            argv = payload.split(b'\0')
+            try:
+                job = Job(req, argv)
+            except OSError as e:
+                writer.send(req, STDERR, ('%s: %s\n' % (
+                    os.fsdecode(argv[0]), e.strerror)).encode())
+                writer.send(req, EXIT, b'127')
+                return
+            jobs[req] = job
+            sel.register(job.proc.stdout, selectors.EVENT_READ, (job, STDOUT))
+            sel.register(job.proc.stderr, selectors.EVENT_READ, (job, STDERR))
+            t = threading.Thread(target=wait, args=(job,))
+            t.daemon = True
+            t.start()
+        elif req in jobs:
+            job = jobs[req]
+            if typ == STDIN and not job.stdin_eof:
+                if payload:
+                    job.stdin_buf += payload
+                else:
+                    job.stdin_eof = True
+                update_stdin(job)
+            elif typ == KILL:
+                job.kill()
+
+    while True:
+        for (key, events) in sel.select():
+            if key.fileobj == rfd:
+                data = os.read(rfd, BLOCK)
+                if not data:
+                    for job in jobs.values():
+                        job.kill()
+                    writer.close()
+                    return
+                for frame in reader.feed(data):
+                    handle(*frame)
+            elif key.fileobj == exited_r:
+                data = os.read(exited_r, BLOCK)
+                for i in range(0, len(data), 4):
+                    finish(jobs[struct.unpack_from('!I', data, i)[0]])
+            elif key.fileobj.closed:
+                # by finish(), for an event of the same select()
+                continue
+            elif events & selectors.EVENT_WRITE:
+                update_stdin(key.data)
+            else:
+                (job, typ) = key.data
+                try:
+                    data = os.read(key.fileobj.fileno(), BLOCK)
+                except BlockingIOError:
+                    continue
+                if data:
+                    writer.send(job.req, typ, data)
+                else:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+
+
+def new_token():
+    '''Return a new random token for listen_vsock()'''
+    return binascii.hexlify(os.urandom(TOKEN_SIZE // 2))
+
+
+def send_token(fd, token):
+    '''Start a connection to listen_vsock() with its token'''
+    write_all(fd, token)
+
+
+def receive_token(conn, timeout=10):
+    '''Read the token that a connection starts with, or what came of it'''
+    conn.settimeout(timeout)
+    data = b''
+    try:
+        while len(data) < TOKEN_SIZE:
+            chunk = conn.recv(TOKEN_SIZE - len(data))
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    conn.settimeout(None)
+    return data
+
+
+def listen_vsock(port, token):
+    '''Serve each connection to the vsock port that sends token, in a child process'''
+    s = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+    # an agent that this one replaces may not have exited yet
+    for retry in range(50):
+        try:
+            s.bind((socket.VMADDR_CID_ANY, port))
+            break
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or retry == 49:
+                raise
+            time.sleep(0.1)
+    s.listen(16)
+    # reap the connection children automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    while True:
+        (conn, addr) = s.accept()
+        if os.fork() == 0:
+            s.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            if hmac.compare_digest(receive_token(conn), token):
+                serve(conn.fileno(), conn.fileno())
+            os._exit(0)
+        conn.close()
+
+
+def run_command(fd, argv, stdin_fd=0, stdout_fd=1, stderr_fd=2):
+    '''Run argv through the agent at the other end of fd
+
+    Its stdin, stdout and stderr are connected to the given fds. Return its
+    exit status.
+    '''
+    send_frame(fd, 1, EXEC, b'\0'.join(os.fsencode(a) for a in argv))
+
+    def send_stdin():
+        while True:
+            data = os.read(stdin_fd, BLOCK)
+            send_frame(fd, 1, STDIN, data)
+            if not data:
+                return
+    t = threading.Thread(target=send_stdin)
+    t.daemon = True
+    t.start()
+
+    reader = FrameReader()
+    while True:
+        data = os.read(fd, BLOCK)
+        if not data:
+            raise EOFError('connection to the agent was closed')
+        for (req, typ, payload) in reader.feed(data):
+            if typ == STDOUT:
+                write_all(stdout_fd, payload)
+            elif typ == STDERR:
+                write_all(stderr_fd, payload)
+            elif typ == EXIT:
+                return int(payload)
+
+
+class Client(object):
+    '''Run commands through the agent at the other end of rfd/wfd
+
+    Unlike run_command(), this keeps the connection, and several threads can
+    run commands at the same time.
+    '''
+
+    def __init__(self, rfd, wfd):
+        self.wfd = wfd
+        self.lock = threading.Lock()
+        self.closed = False
+        self.next_req = 1
+        self.jobs = {}
+        self.thread = threading.Thread(target=self.receive, args=(rfd,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, req, typ, payload=b''):
+        with self.lock:
+            send_frame(self.wfd, req, typ, payload)
+
+    def receive(self, rfd):
+        reader = FrameReader()
+        while True:
+            try:
+                data = os.read(rfd, BLOCK)
+            except OSError:
+                data = b''
+            if not data:
+                with self.lock:
+                    self.closed = True
+                    for job in self.jobs.values():
+                        job['done'].set()
+                return
+            for (req, typ, payload) in reader.feed(data):
+                job = self.jobs.get(req)
+                if job is None:
+                    continue
+                if typ in (STDOUT, STDERR):
+                    out = job[typ]
+                    if not isinstance(out, int):
+                        out.extend(payload)
+                        continue
+                    try:
+                        write_all(out, payload)
+                    except OSError:
+                        # e.g. EPIPE; keep going so the command can finish
+                        pass
+                elif typ == EXIT:
+                    job['rc'] = int(payload)
+                    job['done'].set()
+
+    def run(self, argv, stdin_fd=None, stdout_fd=None, stderr_fd=None, timeout=None):
+        '''Run argv and return (exit status, stdout, stderr)
+
+        Output goes to the given fds, or is returned as bytes if they are None.
+        stdin_fd is read until EOF if given, otherwise stdin is empty. If the
+        command takes longer than timeout seconds, it is killed and the exit
+        status is None; it is also None if the connection was closed. If the
+        killed command does not exit within KILL_WAIT seconds either, the
+        agent is given up on, as if the connection was closed.
+        '''
+        with self.lock:
+            if self.closed:
+                return (None, None, None)
+            req = self.next_req
+            self.next_req += 1
+            job = self.jobs[req] = {
+                'done': threading.Event(), 'rc': None,
+                STDOUT: bytearray() if stdout_fd is None else stdout_fd,
+                STDERR: bytearray() if stderr_fd is None else stderr_fd,
+            }
+        try:
+            self.send(req, EXEC, b'\0'.join(os.fsencode(a) for a in argv))
+            if stdin_fd is None:
+                self.send(req, STDIN)
+            else:
+                def send_stdin():
+                    while not job['done'].is_set():
+                        data = os.read(stdin_fd, BLOCK)
+                        self.send(req, STDIN, data)
+                        if not data:
+                            return
+                t = threading.Thread(target=send_stdin)
+                t.daemon = True
+                t.start()
+            if not job['done'].wait(timeout):
+                self.send(req, KILL)
+                if not job['done'].wait(KILL_WAIT):
+                    with self.lock:
+                        self.closed = True
+                job['rc'] = None
+        finally:
+            with self.lock:
+                del self.jobs[req]
+        return (job['rc'],
+                bytes(job[STDOUT]) if stdout_fd is None else None,
+                bytes(job[STDERR]) if stderr_fd is None else None)
+
+
+def main(argv):
+    if argv[:1] == ['vsock'] and os.environ.get('REPROTEST_AGENT_TOKEN'):
+        # the commands must not see it
+        token = os.environ.pop('REPROTEST_AGENT_TOKEN').encode('ascii')
+        listen_vsock(int(argv[1]), token)
+    elif argv[:1] == ['stdio']:
+        serve(sys.stdin.fileno(), sys.stdout.fileno())
+    else:
+        sys.stderr.write('Usage: REPROTEST_AGENT_TOKEN=TOKEN %s vsock PORT | %s stdio\n'
+                         % (sys.argv[0], sys.argv[0]))
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -95,6 +95,43 @@ def preset_deb_dsc(fn, aux):
         ).set.artifact_pattern("*.deb"
         ).set.source_pattern(" ".join(shlex.quote(a) for a in [fn] + aux))
 
+def build_deps(buildfile):
+    """Return the Build-Depends* fields of a Debian source, or None.
+
+    buildfile is a .dsc file or an unpacked source; --build-pre-once uses
+    this to tell when the build-dependencies installed by a saved testbed
+    are still the right ones.
+    """
+    if os.path.isdir(buildfile):
+        path = os.path.join(buildfile, "debian", "control")
+    elif buildfile.endswith(".dsc"):
+        path = buildfile
+    else:
+        return None
+    fields = []
+    in_source = False
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    # the source paragraph ends, after a PGP header in a .dsc
+                    if in_source:
+                        break
+                elif line.startswith("#"):
+                    # debian/control allows comments, even within fields
+                    continue
+                elif line[0].isspace():
+                    if fields and fields[-1][1] is not None:
+                        fields[-1][1] += " " + line.strip()
+                else:
+                    (name, _, value) = line.partition(":")
+                    in_source = in_source or name == "Source"
+                    fields.append([name, value.strip() if name.startswith(
+                        ("Build-Depends", "Build-Conflicts")) else None])
+    except OSError:
+        return None
+    return "\n".join("%s: %s" % (name, value) for (name, value) in fields if value is not None)
+
 def get_presets(buildfile, virtual_server):
     fn = os.path.basename(buildfile)
     parts = os.path.splitext(fn)
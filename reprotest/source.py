@@ -0,0 +1,252 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+"""Preparing the source tree that is copied into the testbed."""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# the number of prepared source trees that SourceCache keeps
+MAX_SOURCES = 16
+
+
+def expand_globs(root, globs):
+    """Expand the (already sanitized) shell globs relative to root."""
+    out = subprocess.check_output(['sh', '-ec', 'cd "$1"; printf "%s\\0" ' + globs,
+                                   'sh', root])
+    return [os.fsdecode(p) for p in out.split(b'\0')[:-1]]
+
+
+class DirIndex(object):
+    """The names in the directories of a tree, with the mtimes of the directories.
+
+    Adding, removing or renaming an entry changes the mtime of its directory,
+    so the names are reused while that stays the same, and the directory is
+    not read again. Changing a file does not, so files are always lstat()ed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dirs = {}
+        self.changed = False
+        if path:
+            try:
+                with open(path) as f:
+                    self.dirs = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    @classmethod
+    def for_tree(cls, cache_dir, root):
+        """The index of root kept in cache_dir, or an unsaved one if that is None."""
+        if not cache_dir:
+            return cls()
+        key = hashlib.sha256(os.fsencode(os.path.abspath(root))).hexdigest()
+        return cls(os.path.join(cache_dir, 'index', key + '.json'))
+
+    def names(self, root, relpath, st):
+        entry = self.dirs.get(relpath)
+        if entry and entry[0] == st.st_mtime_ns:
+            return entry[1]
+        names = sorted(e.name for e in os.scandir(os.path.join(root, relpath)))
+        # like git's "racy" entries, the directory could still change within
+        # the granularity of its mtime, so don't trust very recent ones
+        if time.time() - st.st_mtime > 2:
+            self.dirs[relpath] = [st.st_mtime_ns, names]
+            self.changed = True
+        return names
+
+    def save(self):
+        if not (self.path and self.changed):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = '%s.%d' % (self.path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(self.dirs, f)
+        os.replace(temp, self.path)
+        self.changed = False
+
+
+def lstat_or_none(path):
+    try:
+        return os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def scan_tree(root, paths=('.',), index=None, threads=16):
+    """Return {relpath: lstat} for paths in root and everything below them, with
+    None for paths that do not exist.
+
+    Directories are read and their entries lstat()ed in parallel, as on network
+    filesystems most of the time is spent waiting for replies. If an index is
+    given, it is used and updated, see DirIndex.
+    """
+    index = index or DirIndex()
+    result = {}
+
+    def scan_dir(relpath, st):
+        children = []
+        for name in index.names(root, relpath, st):
+            child = os.path.normpath(os.path.join(relpath, name))
+            children.append((child, lstat_or_none(os.path.join(root, child))))
+        return children
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = set()
+
+        def add(relpath, st):
+            result[relpath] = st
+            if st and stat.S_ISDIR(st.st_mode):
+                pending.add(pool.submit(scan_dir, relpath, st))
+
+        for path in paths:
+            path = os.path.normpath(path)
+            add(path, lstat_or_none(os.path.join(root, path)))
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for relpath, st in future.result():
+                    add(relpath, st)
+    index.save()
+    return result
+
+
+def fingerprint(source_root, source_pattern=None, *extra, git_rev=None, index=None):
+    """Hash the names, types, sizes and mtimes of the files in source_root that
+    match source_pattern (default: all of them), together with source_pattern
+    itself and extra strings.
+
+    Like make(1), this trusts mtimes to change whenever the contents do. With
+    git_rev, the files are the ones tracked by git at that revision instead,
+    and the id of their git tree is hashed. The index is passed to scan_tree().
+    """
+    h = hashlib.sha256()
+    h.update(os.fsencode(source_pattern or '') + b'\0')
+    for x in extra:
+        h.update(os.fsencode(x or '') + b'\0')
+    if git_rev:
+        h.update(b'git ' + git_tree(source_root, git_rev).encode())
+        return h.hexdigest()
+    tree = scan_tree(source_root, expand_globs(source_root, source_pattern or '.'), index)
+    for relpath, st in sorted(tree.items()):
+        h.update(os.fsencode(relpath) + b'\0')
+        if st is None:
+            h.update(b'missing\0')
+            continue
+        h.update(('%o %d %d\0' % (st.st_mode, st.st_size, st.st_mtime_ns)).encode())
+        if stat.S_ISLNK(st.st_mode):
+            h.update(os.fsencode(os.readlink(os.path.join(source_root, relpath))) + b'\0')
+    return h.hexdigest()
+
+
+class SourceCache(object):
+    """Prepared source trees, stored as cache_dir/sources/<key>.
+
+    Entries are never modified once added, so they can be copied down directly;
+    the whole directory can be deleted at any time to free up space. Adding one
+    evicts those used least recently beyond max_entries.
+    """
+
+    def __init__(self, cache_dir, max_entries=MAX_SOURCES):
+        self.dir = os.path.join(cache_dir, 'sources')
+        self.max_entries = max_entries
+
+    def get(self, key):
+        path = os.path.join(self.dir, key)
+        if not os.path.isdir(path):
+            return None
+        # its mtime is when it was last used, see evict()
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def evict(self):
+        """Remove the entries used least recently until max_entries are left."""
+        entries = []
+        for name in os.listdir(self.dir):
+            if name.startswith('tmp.'):
+                continue
+            try:
+                entries.append((os.stat(os.path.join(self.dir, name)).st_mtime, name))
+            except FileNotFoundError:
+                pass
+        for (mtime, name) in sorted(entries)[:max(len(entries) - self.max_entries, 0)]:
+            logger.debug("evicting cached source tree %s", name)
+            shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+
+    @contextlib.contextmanager
+    def add(self, key):
+        """Context manager giving a directory to fill in; it becomes the entry
+        for key only if the block succeeds, so others never see partial trees."""
+        os.makedirs(self.dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='tmp.', dir=self.dir)
+        try:
+            yield temp_dir
+            try:
+                os.rename(temp_dir, os.path.join(self.dir, key))
+            except OSError:
+                # another run added it in the meantime
+                if not self.get(key):
+                    raise
+            # it is the one used last now, whatever happened to its mtime
+            os.utime(os.path.join(self.dir, key))
+            self.evict()
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir)
+
+
+def git_cmd(source_root, *args):
+    # like reprotest does, use the parent directory if given a file
+    if os.path.isfile(source_root):
+        source_root = os.path.dirname(source_root) or '.'
+    return ['git', '-C', source_root] + list(args)
+
+
+def git_tree(source_root, rev):
+    """Return the id of the git tree of source_root at rev.
+
+    This identifies exactly the files that git_archive() exports.
+    """
+    return subprocess.check_output(git_cmd(source_root, 'rev-parse', '--verify',
+                                           rev + ':./')).decode().strip()
+
+
+def git_commit_time(source_root, rev):
+    """Return the commit time of rev, the mtime of the files it exports."""
+    return int(subprocess.check_output(git_cmd(source_root, 'log', '-1',
+                                               '--format=%ct', rev, '--')))
+
+
+def git_archive(source_root, rev):
+    """Start writing the files tracked by git in source_root at rev, as a tar
+    stream to the stdout of the returned process."""
+    return subprocess.Popen(git_cmd(source_root, 'archive', '--format=tar', rev),
+                            stdout=subprocess.PIPE)
+
+
+def git_export(source_root, rev, dst):
+    """Extract the files tracked by git in source_root at rev into dst."""
+    os.makedirs(dst, exist_ok=True)
+    archive = git_archive(source_root, rev)
+    try:
+        subprocess.check_call(['tar', '-x', '-f', '-', '-C', dst], stdin=archive.stdout)
+    finally:
+        archive.stdout.close()
+        if archive.wait():
+            raise subprocess.CalledProcessError(archive.returncode, archive.args)
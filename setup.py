@@ -16,7 +16,8 @@ setup(name='reprotest',
       packages=find_packages(),
       entry_points={
           'console_scripts': [
-              'reprotest = reprotest:main'
+              'reprotest = reprotest:main',
+              'reprotestd = reprotest.daemon:main',
               ],
           },
       install_requires=[
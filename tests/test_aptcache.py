@@ -0,0 +1,93 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+import shlex
+import shutil
+
+from reprotest import aptcache
+
+
+def add_deb(path, name, size, mtime):
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(os.path.join(path, name), (mtime, mtime))
+
+
+class FakeTestbed(object):
+    """Runs the copies of AptCache on the host, with archives as the testbed's apt archives."""
+
+    def __init__(self, scratch, archives, shared_downtmp=True):
+        self.scratch = scratch
+        self.archives = archives
+        self.shared_downtmp = scratch if shared_downtmp else None
+        self.commands = []
+
+    def check_exec(self, argv, stdout=False):
+        if stdout:
+            return '\n'.join(sorted(os.listdir(self.archives))) + '\n'
+        if argv[-2:] == [os.path.join(self.scratch, 'apt-cache', ''), aptcache.ARCHIVES]:
+            staging = argv[-2]
+            for name in os.listdir(staging):
+                os.replace(os.path.join(staging, name), os.path.join(self.archives, name))
+            os.rmdir(staging)
+
+    def command(self, cmd, args):
+        self.commands.append((cmd, args))
+        if cmd == 'copydown':
+            shutil.copytree(args[0], args[1])
+        elif cmd == 'copyup':
+            # the shell of the testbed gets the pattern in one argument
+            assert len(args[2].encode()) < 128 << 10
+            for name in shlex.split(args[2]):
+                shutil.copy(os.path.join(self.archives, name), args[1])
+
+
+def test_evict(tmpdir):
+    cache = aptcache.AptCache(str(tmpdir), max_size=250)
+    for (i, name) in enumerate(['c.deb', 'a.deb', 'b.deb']):
+        add_deb(str(tmpdir), name, 100, 1000 + i)
+    add_deb(str(tmpdir), 'other', 1000, 1)
+    cache.evict()
+    assert sorted(cache.debs()) == ['a.deb', 'b.deb']
+    assert os.path.exists(str(tmpdir.join('other')))
+    aptcache.AptCache(str(tmpdir)).evict()
+    assert sorted(cache.debs()) == ['a.deb', 'b.deb']
+
+
+def test_patterns():
+    names = ['pkg-%d_1.0_amd64.deb' % i for i in range(10000)]
+    pats = list(aptcache.patterns(names))
+    assert len(pats) > 1
+    assert all(len(p) <= aptcache.PATTERN_MAX for p in pats)
+    assert [n for p in pats for n in shlex.split(p)] == names
+    assert list(aptcache.patterns(["it's.deb"])) == [shlex.quote("it's.deb")]
+    assert list(aptcache.patterns([])) == []
+
+
+def test_seed_and_harvest_large_cache(tmpdir):
+    path, archives = str(tmpdir.mkdir('cache')), str(tmpdir.mkdir('archives'))
+    for i in range(3000):
+        add_deb(path, 'cached-package-%d_1.0-1_amd64.deb' % i, 1, 1000)
+    cache = aptcache.AptCache(path)
+    testbed = FakeTestbed(str(tmpdir.mkdir('scratch')), archives)
+    cache.seed(testbed)
+    # one copy of the directory, rather than a pattern naming every .deb
+    assert [cmd for (cmd, args) in testbed.commands] == ['copydown']
+    assert len(os.listdir(archives)) == 3000
+
+    for i in range(3000):
+        add_deb(archives, 'new-package-%d_1.0-1_amd64.deb' % i, 1, 1000)
+    testbed.commands = []
+    cache.harvest(testbed)
+    assert len(testbed.commands) > 1
+    assert len(cache.debs()) == 6000
+    assert [n for n in os.listdir(path) if not n.endswith('.deb')] == []
+
+
+def test_seed_needs_shared_dir(tmpdir):
+    path, archives = str(tmpdir.mkdir('cache')), str(tmpdir.mkdir('archives'))
+    add_deb(path, 'a.deb', 1, 1000)
+    testbed = FakeTestbed(str(tmpdir.mkdir('scratch')), archives, shared_downtmp=False)
+    aptcache.AptCache(path).seed(testbed)
+    assert testbed.commands == []
@@ -0,0 +1,55 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import subprocess
+
+from reprotest import build
+
+
+def run_phases(phases):
+    p = subprocess.run(['sh', '-c', build.phases_script(phases)],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    return (p.returncode, p.stdout, p.stderr)
+
+
+def test_phases():
+    (code, out, err) = run_phases([('one', ['echo', 'a b']),
+                                   ('two', ['sh', '-c', 'echo c; echo d >&2'])])
+    assert code == 0
+    # the commands' output goes to stderr, only the trailer to stdout
+    assert err == 'a b\nc\nd\n'
+    results = build.parse_phases(out)
+    assert [(name, status) for name, status, seconds in results] == [('one', 0), ('two', 0)]
+    assert all(seconds >= 0 for name, status, seconds in results)
+    assert build.failed_phase(['one', 'two'], results) is None
+
+
+def test_phases_fail_part_way():
+    (code, out, err) = run_phases([('one', ['true']),
+                                   ('two', ['sh', '-c', 'exit 3']),
+                                   ('three', ['echo', 'not run'])])
+    assert code == 3
+    assert 'not run' not in err
+    results = build.parse_phases(out)
+    assert [(name, status) for name, status, seconds in results] == [('one', 0), ('two', 3)]
+    assert build.failed_phase(['one', 'two', 'three'], results) == 'two'
+
+
+def test_parse_phases_interleaved():
+    # e.g. when the testbed merges stdout and stderr
+    output = ('noise\n'
+              'REPROTEST-PHASE one 0 1500\n'
+              'REPROTEST-PHASE looks like one\n'
+              'partial line REPROTEST-PHASE two 0 1\n'
+              'REPROTEST-PHASE two 1 20\n'
+              'more noise')
+    assert build.parse_phases(output) == [('one', 0, 1.5), ('two', 1, 0.02)]
+
+
+def test_parse_phases_missing_markers():
+    assert build.parse_phases('') == []
+    assert build.failed_phase(['one', 'two'], []) == 'one'
+    # killed during two, which did not get to report
+    results = build.parse_phases('REPROTEST-PHASE one 0 10\n')
+    assert build.failed_phase(['one', 'two'], results) == 'two'
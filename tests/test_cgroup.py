@@ -0,0 +1,44 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import pytest
+
+from reprotest import cgroup
+
+# what the wrapper writes to the stats file, from cpu.stat, memory.peak and io.stat
+STATS = '''cpu.usage_usec 2500000
+cpu.user_usec 2000000
+cpu.system_usec 500000
+cpu.nr_periods 0
+cpu.nr_throttled 0
+cpu.throttled_usec 0
+memory.peak 104857600
+io.rbytes 4096
+io.wbytes 1048576
+'''
+
+
+def test_parse_stats():
+    assert cgroup.parse_stats(STATS) == {
+        'cpu_seconds': '2.500',
+        'cpu_user_seconds': '2.000',
+        'cpu_system_seconds': '0.500',
+        'memory_peak': 104857600,
+        'io_read_bytes': 4096,
+        'io_write_bytes': 1048576,
+    }
+
+
+def test_parse_stats_partial():
+    # no memory.peak before Linux 5.19, and cat fails with nothing on stdout
+    assert cgroup.parse_stats('cpu.usage_usec 1000\nmemory.peak \nio.rbytes 0\n') == {
+        'cpu_seconds': '0.001', 'io_read_bytes': 0}
+    assert cgroup.parse_stats('') == {}
+
+
+def test_parse_size():
+    assert cgroup.parse_size('512') == 512
+    assert cgroup.parse_size('2k') == 2048
+    assert cgroup.parse_size('8G') == 8 << 30
+    with pytest.raises(ValueError):
+        cgroup.parse_size('1.5G')
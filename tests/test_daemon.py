@@ -0,0 +1,145 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import json
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+import reprotest
+from reprotest import daemon
+
+
+def test_job_round_trip():
+    (client, server) = socket.socketpair()
+    result = []
+    t = threading.Thread(target=lambda: result.append(daemon.send_job(client, ['--help', 'x' * 100000])))
+    t.start()
+    (request, fds) = daemon.receive_job(server)
+    assert request['argv'] == ['--help', 'x' * 100000]
+    assert request['cwd'] == os.getcwd()
+    assert request['env'] == dict(os.environ)
+    # the client's stdin, stdout and stderr
+    assert len(fds) == 3
+    assert [os.path.sameopenfile(fd, i) for (i, fd) in enumerate(fds)] == [True] * 3
+    for fd in fds:
+        os.close(fd)
+    server.sendall(json.dumps({'returncode': 3}).encode() + b'\n')
+    t.join()
+    assert result == [3]
+    assert daemon.peer_uid(server) == os.getuid()
+    client.close()
+    server.close()
+
+
+def test_job_without_result():
+    (client, server) = socket.socketpair()
+    t = threading.Thread(target=lambda: (daemon.receive_job(server), server.close()))
+    t.start()
+    assert daemon.send_job(client, ['x']) == 125
+    t.join()
+    client.close()
+
+
+def test_private_dir(tmpdir):
+    path = str(tmpdir.join('private'))
+    daemon.private_dir(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+    daemon.private_dir(path)
+    os.chmod(path, 0o755)
+    with pytest.raises(RuntimeError):
+        daemon.private_dir(path)
+
+
+class FakeTestbed(object):
+    def __init__(self, caps, has_snapshot):
+        self.caps = caps
+        self.has_snapshot = has_snapshot
+        self.log = []
+
+    def start_agent(self):
+        pass
+
+    def stop_agent(self):
+        pass
+
+    def snapshot(self):
+        self.log.append('snapshot')
+        self.has_snapshot = True
+
+
+class FakeWarm(object):
+    def __init__(self, testbed):
+        self.testbed = testbed
+
+    def matches(self, *args):
+        return True
+
+
+def use_warm(monkeypatch, warm, **kwargs):
+    monkeypatch.setattr(reprotest, 'warm_testbed', warm)
+    try:
+        with reprotest.start_testbed(['null'], None, **kwargs) as testbed:
+            return testbed
+    except RuntimeError:
+        # start_testbed went on to start a testbed of its own
+        return None
+
+
+def test_warm_testbed_setup(monkeypatch):
+    tb = FakeTestbed(['snapshot'], True)
+    setup = lambda testbed: testbed.log.append('setup')
+    assert use_warm(monkeypatch, FakeWarm(tb), setup=setup) is tb
+    # the snapshot of reprotestd is not for the builds
+    assert tb.log == ['setup'] and not tb.has_snapshot
+
+    tb = FakeTestbed(['snapshot'], True)
+    assert use_warm(monkeypatch, FakeWarm(tb), snapshot=True) is tb
+    assert tb.log == [] and tb.has_snapshot
+
+    tb = FakeTestbed([], False)
+    assert use_warm(monkeypatch, FakeWarm(tb), setup=setup, snapshot=True) is tb
+    assert tb.log == ['setup']
+
+
+def test_warm_testbed_not_used(monkeypatch):
+    def no_server(name):
+        raise RuntimeError('no warm testbed used')
+    monkeypatch.setattr(reprotest, 'get_server_path', no_server)
+    # it would replace the snapshot that reprotestd reverts to
+    tb = FakeTestbed(['snapshot'], True)
+    assert use_warm(monkeypatch, FakeWarm(tb), setup=lambda testbed: None, snapshot=True) is None
+    assert use_warm(monkeypatch, FakeWarm(tb), bake=True) is None
+
+
+class RevertingTestbed(FakeTestbed):
+    def revert_snapshot(self):
+        self.log.append('revert')
+
+    def check_exec2(self, argv):
+        self.log.append(argv[-1])
+
+
+def warm_testbed(caps, has_snapshot):
+    warm = daemon.WarmTestbed.__new__(daemon.WarmTestbed)
+    (warm.virtual_server_args, warm.testbed_init) = (['schroot', 'unstable'], 'init')
+    warm.testbed = RevertingTestbed(caps, has_snapshot)
+    return warm
+
+
+def test_warm_testbed_clean():
+    # back to the snapshot after testbed_init
+    warm = warm_testbed(['snapshot', 'revert'], True)
+    warm.clean()
+    assert warm.testbed.log == ['revert']
+    # back to the start, then testbed_init again
+    warm = warm_testbed(['revert'], False)
+    warm.clean()
+    assert warm.testbed.log == ['revert', 'init']
+    # dropped
+    warm = warm_testbed([], False)
+    with pytest.raises(RuntimeError):
+        warm.clean()
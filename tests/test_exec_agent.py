@@ -0,0 +1,114 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from reprotest.lib import exec_agent
+
+
+@pytest.fixture
+def agent():
+    (client, server) = socket.socketpair()
+    t = threading.Thread(target=exec_agent.serve,
+                         args=(server.fileno(), server.fileno()), daemon=True)
+    t.start()
+    yield client
+    # also wakes up the readers of client, unlike close()
+    client.shutdown(socket.SHUT_RDWR)
+    client.close()
+    t.join()
+    server.close()
+
+
+def run(agent, argv, stdin=b''):
+    (in_r, in_w) = os.pipe()
+    (out_r, out_w) = os.pipe()
+    out = []
+
+    def feed():
+        exec_agent.write_all(in_w, stdin)
+        os.close(in_w)
+
+    def collect():
+        with os.fdopen(out_r, 'rb') as f:
+            out.append(f.read())
+
+    threads = [threading.Thread(target=feed), threading.Thread(target=collect)]
+    for t in threads:
+        t.start()
+    rc = exec_agent.run_command(agent.fileno(), argv, in_r, out_w, out_w)
+    os.close(out_w)
+    for t in threads:
+        t.join()
+    os.close(in_r)
+    return rc, out[0]
+
+
+def test_run_command(agent):
+    data = b'0123456789abcdef\n' * 100000
+    assert run(agent, ['cat'], data) == (0, data)
+    assert run(agent, ['sh', '-c', 'echo err >&2; exit 3']) == (3, b'err\n')
+    assert run(agent, ['sh', '-c', 'kill -9 $$']) == (137, b'')
+    (rc, out) = run(agent, ['/nonexistent'])
+    assert rc == 127 and b'No such file' in out
+
+
+def test_client(agent):
+    client = exec_agent.Client(agent.fileno(), agent.fileno())
+    results = {}
+
+    def run(i):
+        results[i] = client.run(['sh', '-c', 'sleep 0.2; echo $0; echo e >&2', str(i)])
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == dict((i, (0, b'%d\n' % i, b'e\n')) for i in range(4))
+    assert client.run(['sleep', '10'], timeout=0.2) == (None, b'', b'')
+
+
+def test_exit_with_background_children(agent):
+    client = exec_agent.Client(agent.fileno(), agent.fileno())
+    start = time.time()
+    # the sleep keeps stdout and stderr open after the command exited
+    (rc, out, err) = client.run(['sh', '-c', 'echo out; echo err >&2; sleep 3 & exit 4'], timeout=10)
+    assert (rc, out, err) == (4, b'out\n', b'err\n')
+    assert time.time() - start < 2
+
+
+def test_client_gives_up_on_hung_agent(monkeypatch):
+    monkeypatch.setattr(exec_agent, 'KILL_WAIT', 0.2)
+    # nothing serves the other end, like an agent that hangs
+    (client_sock, server_sock) = socket.socketpair()
+    client = exec_agent.Client(client_sock.fileno(), client_sock.fileno())
+    start = time.time()
+    assert client.run(['true'], timeout=0.2) == (None, b'', b'')
+    assert time.time() - start < 5
+    assert client.closed
+    assert client.run(['true']) == (None, None, None)
+    client_sock.shutdown(socket.SHUT_RDWR)
+    client_sock.close()
+    server_sock.close()
+
+
+def test_token():
+    token = exec_agent.new_token()
+    assert len(token) == exec_agent.TOKEN_SIZE
+    assert token != exec_agent.new_token()
+    (client, server) = socket.socketpair()
+    with client, server:
+        exec_agent.send_token(client.fileno(), token[:10])
+        exec_agent.send_token(client.fileno(), token[10:] + b'rest')
+        assert exec_agent.receive_token(server) == token
+        assert server.recv(4) == b'rest'
+        # a connection that does not send all of it
+        exec_agent.send_token(client.fileno(), token[:10])
+        assert exec_agent.receive_token(server, timeout=0.1) == token[:10]
+        client.shutdown(socket.SHUT_WR)
+        assert exec_agent.receive_token(server) == b''
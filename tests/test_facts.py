@@ -0,0 +1,84 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+import subprocess
+
+from reprotest import facts
+from reprotest.build import TestbedFacts
+from reprotest.lib import adt_testbed
+
+
+class LocalTestbed(adt_testbed.Testbed):
+    """Runs the probes here, and counts them."""
+
+    def __init__(self, output_dir=None):
+        super().__init__(['true'], output_dir, 'user', host_distro='debian')
+        self.probed = []
+
+    def check_exec(self, argv, stdout=False, kind='short'):
+        script = argv[-1]
+        self.probed += [line.split("'")[1].split()[1] for line in script.splitlines()
+                        if line.startswith("echo '" + adt_testbed.FACT_MARKER)]
+        return subprocess.check_output(argv, universal_newlines=True)
+
+
+def test_testbed_facts_of():
+    probed = {'machine': 'x86_64\n', 'kernel-release': '6.1.0\n',
+              'setarch': 'x86_64\ni386\n', 'nproc': '4\n', 'kernel': 'Linux'}
+    assert TestbedFacts.of(probed) == TestbedFacts('x86_64', '6.1.0', ['x86_64', 'i386'], 4)
+    del probed['setarch']
+    assert TestbedFacts.of(probed) is None
+    assert TestbedFacts.of(dict(probed, setarch='', nproc='')) is None
+    assert TestbedFacts.of(None) is None
+
+
+def test_probe_facts():
+    tb = LocalTestbed()
+    tb.probe_facts()
+    assert tb.facts['nproc'].strip().isdigit()
+    assert tb.facts['machine'] == subprocess.check_output(['uname', '-m'], universal_newlines=True)
+    # multi-line outputs are kept whole, without the markers
+    assert tb.facts['cpuinfo'] == open('/proc/cpuinfo').read()
+    assert adt_testbed.FACT_MARKER not in ''.join(tb.facts.values())
+    assert 'packages' not in tb.facts
+    assert TestbedFacts.of(tb.facts) is not None
+
+
+def test_probe_facts_only_unknown():
+    tb = LocalTestbed()
+    tb.facts = {'machine': 'cached\n'}
+    tb.probe_facts()
+    assert tb.facts['machine'] == 'cached\n'
+    assert 'machine' not in tb.probed and 'nproc' in tb.probed
+    tb.probed = []
+    tb.probe_facts()
+    assert tb.probed == []
+
+
+def test_facts_cache_volatile(tmpdir):
+    cache = facts.FactsCache(str(tmpdir), adt_testbed.VOLATILE_FACTS)
+    assert cache.get('key') is None
+    tb = LocalTestbed()
+    tb.probe_facts()
+    cache.put('key', dict(tb.facts, packages='a\t1\n'))
+    cached = cache.get('key')
+    assert 'eatmydata' not in cached and 'packages' not in cached
+    assert cached['nproc'] == tb.facts['nproc']
+    # they are probed again when the next testbed opens
+    tb = LocalTestbed()
+    tb.facts = cached
+    tb.probe_facts()
+    assert tb.probed == ['eatmydata']
+
+
+def test_facts_key(tmpdir, monkeypatch):
+    image = tmpdir.join('base.img')
+    image.write('disk')
+    null_key = facts.facts_key(['null'])
+    image_key = facts.facts_key(['qemu', str(image)])
+    assert facts.facts_key(['null']) == null_key
+    # the host's CPUs changed
+    monkeypatch.setattr(os, 'cpu_count', lambda: 1024)
+    assert facts.facts_key(['null']) != null_key
+    assert facts.facts_key(['qemu', str(image)]) == image_key
@@ -0,0 +1,49 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+
+from reprotest import images
+
+
+def test_registry(tmpdir):
+    registry = images.ImageRegistry(str(tmpdir))
+    key = images.image_key(['qemu', 'base.img'], 'apt-get install -y foo')
+    assert registry.get(key) is None
+    assert registry.path(key) == os.path.join(str(tmpdir), 'images', key)
+
+    registry.put(key, registry.path(key), ['qemu', 'base.img'], 'apt-get install -y foo')
+    baked = registry.get(key)
+    assert baked['image'] == registry.path(key)
+    assert baked['virtual_server_args'] == ['qemu', 'base.img']
+    assert baked['testbed_init'] == 'apt-get install -y foo'
+    assert os.listdir(os.path.join(str(tmpdir), 'images')) == [key + '.json']
+
+    registry.remove(key)
+    assert registry.get(key) is None
+    # removing it twice is fine, e.g. when two runs found it gone
+    registry.remove(key)
+
+
+def test_registry_broken(tmpdir):
+    registry = images.ImageRegistry(str(tmpdir))
+    os.makedirs(os.path.join(str(tmpdir), 'images'))
+    with open(registry.path('key') + '.json', 'w') as f:
+        f.write('{"image": ')
+    assert registry.get('key') is None
+
+
+def test_image_key(tmpdir):
+    base = tmpdir.join('base.img')
+    base.write('disk')
+    args = ['qemu', str(base)]
+    key = images.image_key(args, 'init')
+    assert images.image_key(args, 'init') == key
+    # other init commands, another testbed or another distro make another image
+    assert images.image_key(args, 'other init') != key
+    assert images.image_key(args, None) != key
+    assert images.image_key(['qemu', '--ram-size=2048', str(base)], 'init') != key
+    assert images.image_key(args, 'init', 'arch') != key
+    # and so does updating the base image
+    base.write('updated disk')
+    assert images.image_key(args, 'init') != key
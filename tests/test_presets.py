@@ -0,0 +1,58 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+from reprotest import presets
+
+CONTROL = """Source: hello
+Section: devel
+Build-Depends: debhelper-compat (= 13),
+ libfoo-dev,
+# a comment
+ libbar-dev
+Build-Depends-Indep: python3-sphinx
+Build-Conflicts: libbaz-dev
+Standards-Version: 4.6.0
+
+Package: hello
+Architecture: any
+Depends: ${misc:Depends}
+"""
+
+DEPS = ("Build-Depends: debhelper-compat (= 13), libfoo-dev, libbar-dev\n"
+        "Build-Depends-Indep: python3-sphinx\n"
+        "Build-Conflicts: libbaz-dev")
+
+
+def test_build_deps_control(tmpdir):
+    tmpdir.mkdir('debian').join('control').write(CONTROL)
+    assert presets.build_deps(str(tmpdir)) == DEPS
+    # only the Build-* fields count
+    tmpdir.join('debian', 'control').write(CONTROL.replace('4.6.0', '4.7.0')
+                                           .replace('${misc:Depends}', 'libc6'))
+    assert presets.build_deps(str(tmpdir)) == DEPS
+
+
+def test_build_deps_dsc(tmpdir):
+    dsc = tmpdir.join('hello_1.0.dsc')
+    dsc.write("-----BEGIN PGP SIGNED MESSAGE-----\n"
+              "Hash: SHA256\n"
+              "\n"
+              "Format: 3.0 (quilt)\n"
+              "Source: hello\n"
+              "Binary: hello\n"
+              "Build-Depends: debhelper-compat (= 13), libfoo-dev\n"
+              "Checksums-Sha256:\n"
+              " 0123 1000 hello_1.0.orig.tar.gz\n"
+              "\n"
+              "-----BEGIN PGP SIGNATURE-----\n"
+              "\n"
+              "Build-Depends: not-a-field\n"
+              "-----END PGP SIGNATURE-----\n")
+    assert presets.build_deps(str(dsc)) == "Build-Depends: debhelper-compat (= 13), libfoo-dev"
+
+
+def test_build_deps_none(tmpdir):
+    assert presets.build_deps(str(tmpdir)) is None
+    assert presets.build_deps(str(tmpdir.join('missing.dsc'))) is None
+    tmpdir.join('hello.tar.gz').write('')
+    assert presets.build_deps(str(tmpdir.join('hello.tar.gz'))) is None
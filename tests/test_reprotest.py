@@ -126,6 +126,13 @@ def test_command_lines():
     _, testbed_args, _ = check_command_line(". -- schroot unstable-amd64-sbuild".split(), 0)
     assert testbed_args.virtual_server_args == ['schroot', 'unstable-amd64-sbuild']
 
+def test_command_lines_fast_io(caplog):
+    # the default +all varies fileordering already
+    reprotest.run(['--fast-io', '-c', 'true', '.', 'x'], dry_run=True)
+    assert 'vary fileordering' not in caplog.text
+    reprotest.run(['--fast-io', '--vary=-fileordering', '-c', 'true', '.', 'x'], dry_run=True)
+    assert 'vary fileordering' in caplog.text
+
 # TODO: don't call it if we don't have debian/, e.g. for other distros
 @pytest.mark.need_builddeps
 def test_debian_build(virtual_server):
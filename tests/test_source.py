@@ -0,0 +1,129 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+import subprocess
+import threading
+
+from reprotest import build, in_background, prepare_source, source
+
+
+def test_fingerprint(tmpdir):
+    tmpdir.join('a.dsc').write('x')
+    tmpdir.join('other').write('y')
+    fp = source.fingerprint(str(tmpdir), '*.dsc')
+    assert source.fingerprint(str(tmpdir), '*.dsc', 'pre') != fp
+    tmpdir.join('other').write('yy')
+    assert source.fingerprint(str(tmpdir), '*.dsc') == fp
+    tmpdir.join('a.dsc').write('xx')
+    assert source.fingerprint(str(tmpdir), '*.dsc') != fp
+
+
+def test_prepare_source_cached(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('f').write('1')
+    cache_dir, temp_dir = str(tmpdir.join('cache')), str(tmpdir.mkdir('tmp'))
+    pre = 'touch prepared'
+    d0, pattern, rev = prepare_source(str(src), None, pre, temp_dir, cache_dir)
+    d1, pattern, rev = prepare_source(str(src), None, pre, temp_dir, cache_dir)
+    assert d0 == d1 and d0.startswith(cache_dir) and pattern is None
+    assert sorted(os.listdir(d0)) == ['f', 'prepared']
+    assert len(tmpdir.join('cache', 'sources').listdir()) == 1
+    src.join('f').write('2')
+    os.utime(str(src.join('f')), (1, 1))
+    assert prepare_source(str(src), None, pre, temp_dir, cache_dir)[0] != d0
+
+
+def test_prepare_source_git(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('tracked').write('1')
+    git = ['git', '-C', str(src), '-c', 'user.name=r', '-c', 'user.email=r@example.org']
+    subprocess.check_call(git + ['init', '-q'])
+    subprocess.check_call(git + ['add', 'tracked'])
+    subprocess.check_call(git + ['commit', '-q', '-m', 'init'])
+    src.join('untracked').write('2')
+    temp_dir = str(tmpdir.mkdir('tmp'))
+    assert prepare_source(str(src), None, None, temp_dir, git_rev='HEAD') == (str(src), None, 'HEAD')
+    d, pattern, rev = prepare_source(str(src), None, 'touch prepared', temp_dir, git_rev='HEAD')
+    assert sorted(os.listdir(d)) == ['prepared', 'tracked'] and rev is None
+    d, pattern, rev = prepare_source(str(src), './t*', None, temp_dir, git_rev='HEAD')
+    assert os.listdir(d) == ['tracked'] and pattern == './t*' and rev is None
+
+
+def test_scan_tree_index(tmpdir):
+    tmpdir.mkdir('d').join('f').write('1')
+    os.utime(str(tmpdir.join('d')), (1, 1))
+    index_file = str(tmpdir.join('index.json'))
+    index = source.DirIndex(index_file)
+    assert sorted(source.scan_tree(str(tmpdir.join('d')), index=index)) == ['.', 'f']
+    assert os.path.exists(index_file)
+
+    # the names are reused while the directory mtime stays the same ...
+    tmpdir.join('d', 'g').write('2')
+    os.utime(str(tmpdir.join('d')), (1, 1))
+    tree = source.scan_tree(str(tmpdir.join('d')), index=source.DirIndex(index_file))
+    assert sorted(tree) == ['.', 'f']
+    # ... but files are always looked at
+    os.utime(str(tmpdir.join('d', 'f')), (5, 5))
+    assert build.auto_source_date_epoch(str(tmpdir.join('d')), source.DirIndex(index_file)) == 5
+    os.utime(str(tmpdir.join('d')), (2, 2))
+    tree = source.scan_tree(str(tmpdir.join('d')), index=source.DirIndex(index_file))
+    assert sorted(tree) == ['.', 'f', 'g']
+
+
+def test_auto_source_date_epoch(tmpdir):
+    tmpdir.mkdir('sub').join('f').write('x')
+    os.utime(str(tmpdir.join('sub', 'f')), (1000, 1000))
+    tmpdir.join('g').write('y')
+    os.utime(str(tmpdir.join('g')), (500, 500))
+    os.utime(str(tmpdir.join('sub')), (2000, 2000))
+    # directories do not count
+    assert build.auto_source_date_epoch(str(tmpdir)) == 1000
+    # neither do files given as the source root, like a .dsc
+    assert build.auto_source_date_epoch(str(tmpdir.join('g'))) == 1
+    assert build.auto_source_date_epoch(str(tmpdir.mkdir('empty'))) == 1
+
+
+def test_in_background_does_not_wait():
+    started, release, cleaned = threading.Event(), threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(10)
+        return 1
+    try:
+        with in_background(slow, cleanup=cleaned.set) as prepared:
+            started.wait(10)
+            raise RuntimeError('the testbed failed to start')
+    except RuntimeError:
+        pass
+    # left to finish on its own, and cleaned up after that
+    assert not prepared.done() and not cleaned.is_set()
+    release.set()
+    assert cleaned.wait(10)
+    assert prepared.result() == 1
+
+    with in_background(lambda x: x + 1, 1, cleanup=cleaned.set) as prepared:
+        assert prepared.result() == 2
+
+
+def test_fingerprint_pattern(tmpdir):
+    tmpdir.join('a').write('x')
+    # the same files, but the pattern is part of what is prepared
+    assert source.fingerprint(str(tmpdir), './a') != source.fingerprint(str(tmpdir), './a ./b')
+
+
+def test_source_cache_evict(tmpdir):
+    cache = source.SourceCache(str(tmpdir), max_entries=2)
+    for key in ['one', 'two']:
+        with cache.add(key) as path:
+            open(os.path.join(path, 'f'), 'w').close()
+    os.utime(cache.get('one'), (1, 1))
+    os.utime(cache.get('two'), (2, 2))
+    # using it makes it the most recent
+    assert cache.get('one')
+    with cache.add('three') as path:
+        pass
+    assert cache.get('two') is None
+    assert cache.get('one') and cache.get('three')
+    assert sorted(os.listdir(cache.dir)) == ['one', 'three']
@@ -0,0 +1,150 @@
+# Licensed under the GPL: https://www.gnu.org/licenses/gpl-3.0.en.html
+# For details: reprotest/debian/copyright
+
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from reprotest.lib import VirtSubproc
+
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, 'sub'))
+    with open(os.path.join(root, 'a'), 'w') as f:
+        f.write('hello')
+    with open(os.path.join(root, 'sub', 'b'), 'w') as f:
+        f.write('world' * 1000)
+    os.symlink('a', os.path.join(root, 'link'))
+    os.utime(os.path.join(root, 'a'), (1, 1))
+
+
+def test_copy_file(tmpdir):
+    src, dst = str(tmpdir.mkdir('src')), str(tmpdir.mkdir('dst'))
+    make_tree(src)
+    VirtSubproc.copy_file(os.path.join(src, 'a'), os.path.join(dst, 'a'))
+    VirtSubproc.copy_file(os.path.join(src, 'link'), os.path.join(dst, 'link'))
+    with open(os.path.join(dst, 'a')) as f:
+        assert f.read() == 'hello'
+    assert os.stat(os.path.join(dst, 'a')).st_mtime == 1
+    assert os.readlink(os.path.join(dst, 'link')) == 'a'
+    assert (os.stat(os.path.join(dst, 'a')).st_ino !=
+            os.stat(os.path.join(src, 'a')).st_ino)
+
+
+def test_copytree_hardlink_and_merge(tmpdir):
+    src, dst = str(tmpdir.mkdir('src')), str(tmpdir.join('dst'))
+    make_tree(src)
+    VirtSubproc.copytree(src, dst, hardlink=True)
+    assert (os.stat(os.path.join(dst, 'sub', 'b')).st_ino ==
+            os.stat(os.path.join(src, 'sub', 'b')).st_ino)
+
+    with open(os.path.join(src, 'c'), 'w') as f:
+        f.write('new')
+    VirtSubproc.copytree(src, dst)
+    assert sorted(os.listdir(dst)) == ['a', 'c', 'link', 'sub']
+    with open(os.path.join(dst, 'sub', 'b')) as f:
+        assert f.read() == 'world' * 1000
+
+
+def test_pattern_dest():
+    assert VirtSubproc.pattern_dest('./a/b', '/d/src') == '/d/src/a/b'
+    assert VirtSubproc.pattern_dest('./../x.deb', '/d/src') == '/d/x.deb'
+    assert VirtSubproc.pattern_dest('./../../x', '/d/src') == '/d/x'
+    assert VirtSubproc.pattern_dest('./a/../../x', '/d/src') == '/d/x'
+
+
+def test_timeouts_per_thread():
+    results = {}
+
+    def run(name, secs):
+        try:
+            VirtSubproc.execute_timeout(None, secs, ['sleep', '0.5'])
+            results[name] = 'done'
+        except VirtSubproc.Timeout:
+            results[name] = 'timeout'
+    threads = [threading.Thread(target=run, args=('short', 0.1)),
+               threading.Thread(target=run, args=('long', 5))]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {'short': 'timeout', 'long': 'done'}
+    assert time.monotonic() - start < 2
+
+    # the earliest deadline wins, and stopping it leaves the outer one
+    with VirtSubproc.timeout(5):
+        with pytest.raises(VirtSubproc.Timeout):
+            with VirtSubproc.timeout(0.1):
+                VirtSubproc.sleep(1)
+        assert 4 < VirtSubproc.remaining_time() <= 5
+    assert VirtSubproc.remaining_time() is None
+
+
+def test_expect():
+    (a, b) = socket.socketpair()
+    b.sendall(b'x' * 200000 + b'log')
+    b.sendall(b'in: ')
+    out = VirtSubproc.expect(a, b'login: ', 5)
+    assert out.endswith(b'xlogin: ') and len(out) <= VirtSubproc.expect_keep + 65536
+    with pytest.raises(VirtSubproc.Timeout):
+        VirtSubproc.expect(a, b'#', 0.1)
+    b.close()
+    with pytest.raises(VirtSubproc.Timeout):
+        VirtSubproc.expect(a, b'#', 5)
+    a.close()
+
+
+def test_read_command():
+    (r, w) = os.pipe()
+    os.set_blocking(r, False)
+    os.write(w, b'open\n\ncopydown a')
+    assert VirtSubproc.read_command(r) == 'open'
+    threading.Timer(0.1, os.write, (w, b' b\n')).start()
+    assert VirtSubproc.read_command(r) == 'copydown a b'
+    os.close(w)
+    assert VirtSubproc.read_command(r) is None
+    os.close(r)
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_transfer_stats(tmpdir, monkeypatch, shared):
+    src, tb = str(tmpdir.mkdir('src')), str(tmpdir.mkdir('downtmp'))
+    make_tree(src)
+    caps = ['downtmp-host=' + tb] if shared else []
+    monkeypatch.setattr(VirtSubproc, 'caller', type('Caller', (), {
+        'hook_capabilities': staticmethod(lambda: caps)}))
+    monkeypatch.setattr(VirtSubproc, 'downtmp', tb)
+    # the "testbed" is here
+    monkeypatch.setattr(VirtSubproc, 'auxverb', [])
+
+    VirtSubproc.copyupdown_internal('copydown', (src + '/', tb + '/tree/'), False)
+    # regular files only, as they are copied
+    assert VirtSubproc.last_transfer[:2] == (2, 5 + 5000)
+    assert VirtSubproc.last_transfer[3] == (shared and 'shared-dir' or 'tar')
+    assert os.readlink(os.path.join(tb, 'tree', 'link')) == 'a'
+
+    dst = str(tmpdir.join('dst'))
+    VirtSubproc.copyupdown_internal('copyup', (tb + '/tree/', dst + '/'), True)
+    assert VirtSubproc.last_transfer[:2] == (2, 5 + 5000)
+    VirtSubproc.copyupdown_internal('copyup', (tb + '/tree/', dst + '/'), True, './sub')
+    assert VirtSubproc.last_transfer[:2] == (1, 5000)
+    VirtSubproc.copyupdown_internal('copyup', (tb + '/tree/a', dst + '/a'), True)
+    assert VirtSubproc.last_transfer[:2] == (1, 5)
+
+
+def test_copytree_merge_keeps_times(tmpdir):
+    src, dst = str(tmpdir.mkdir('src')), str(tmpdir.join('dst'))
+    make_tree(src)
+    os.makedirs(os.path.join(dst, 'sub'))
+    os.utime(os.path.join(src, 'link'), (2, 2), follow_symlinks=False)
+    os.utime(os.path.join(src, 'sub'), (3, 3))
+    os.utime(src, (4, 4))
+    VirtSubproc.copytree(src, dst)
+    assert os.lstat(os.path.join(dst, 'link')).st_mtime == 2
+    assert os.stat(os.path.join(dst, 'sub')).st_mtime == 3
+    assert os.stat(dst).st_mtime == 4
+    assert os.stat(os.path.join(dst, 'a')).st_mtime == 1